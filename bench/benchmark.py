@@ -0,0 +1,177 @@
+""" Offline benchmarks for the Service cog.
+
+Runs the cog against a local stand-in for itunes.apple.com, an in-memory
+spreadsheet and a stubbed Discord client, with N users watching M apps each
+(drawn from a shared pool, see --overlap), and reports wall time, calls
+issued and peak Python memory for a notify() sweep, watch-list renders and
+multi-ID adds.
+
+    python bench/benchmark.py --users 200 --apps 30 --overlap 0.8 --latency 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.utils.store import HEADER  # noqa: E402
+from fakes import FakeAppStore, FakeBot, FakeContext, FakeSpreadsheet  # noqa: E402
+
+
+
+def install_config(args, appstore_url):
+    """ The cog reads the bot's config module; give it a local one """
+    config = types.ModuleType("config")
+    config.store = args.store
+    config.database = ":memory:"
+    config.appstore_url = appstore_url
+    config.appstore_rate = args.appstore_rate
+    config.appstore_burst = args.appstore_rate
+    config.metrics_port = 0
+    config.snapshot_path = os.devnull
+    sys.modules["config"] = config
+
+
+def make_apps(count):
+    return [{
+        "bundleId": "com.bench.app{}".format(i),
+        "trackName": "Bench App {}".format(i),
+        "version": "2.{}".format(i % 10),
+        "currentVersionReleaseDate": "2019-06-{:02d}T12:00:00Z".format(1 + i % 28),
+        "artworkUrl512": "https://example.com/{}.png".format(i),
+        "artworkUrl100": "https://example.com/{}.png".format(i),
+        "trackViewUrl": "https://example.com/app/{}".format(i),
+        "sellerName": "Bench",
+        "formattedPrice": "Free",
+        } for i in range(count)]
+
+
+def make_watch_lists(args, apps):
+    """ {user_id: rows}; a pool of N*M*(1-overlap) apps, at least M, shared by all users """
+    rng = random.Random(args.seed)
+    pool = apps[:max(args.apps, int(args.users * args.apps * (1 - args.overlap)))]
+    watch_lists = {}
+    for user in range(1, args.users + 1):
+        rows = []
+        for app in rng.sample(pool, args.apps):
+            outdated = rng.random() < args.outdated
+            rows.append([app["bundleId"], app["trackName"], "1.0" if outdated else app["version"], "us", app["artworkUrl512"], app["trackViewUrl"], "0"])
+        watch_lists[str(user)] = rows
+    return watch_lists
+
+
+class Run:
+    """ Measures one scenario: wall time, peak traced memory and calls to each fake """
+    def __init__(self, name, appstore, spreadsheet, bot):
+        self.name = name
+        self.appstore = appstore
+        self.spreadsheet = spreadsheet
+        self.bot = bot
+
+    def __enter__(self):
+        self.lookups = dict(self.appstore.requests)
+        self.errors = self.appstore.errors
+        self.sheets = sum(self.spreadsheet.calls.values())
+        self.dms = self.bot.dms_sent
+        tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("{:<10} {:>9.3f}s  {:>7} lookups  {:>6} searches  {:>5} errors  {:>7} sheets calls  {:>6} DMs  {:>8.1f} MiB peak".format(
+            self.name, elapsed,
+            self.appstore.requests["lookup"] - self.lookups["lookup"],
+            self.appstore.requests["search"] - self.lookups["search"],
+            self.appstore.errors - self.errors,
+            sum(self.spreadsheet.calls.values()) - self.sheets,
+            self.bot.dms_sent - self.dms,
+            peak / 2 ** 20,
+            ))
+
+
+async def sweep(cog):
+    """ One full notify() pass: every watched app due at once, through the whole pipeline """
+    await cog.build_index()
+    tasks = cog.start_pipeline()
+    await cog.run_sweep(now=time.time() + 1, spread=0)
+    await cog.dm_queue.join()
+    if hasattr(cog.store.backend, "flush"):
+        await cog.store.backend.flush()
+    for task in tasks:
+        task.cancel()
+
+
+async def main(args):
+    apps = make_apps(max(args.apps, int(args.users * args.apps * (1 - args.overlap))) + 100)
+    appstore = FakeAppStore(apps, latency=args.latency / 1000, error_rate=args.error_rate)
+    await appstore.start()
+    install_config(args, appstore.url)
+    from cogs.service import Service
+    from cogs.utils.appstore import version_cache
+    from cogs.utils.store import SQLiteStore
+
+    spreadsheet = FakeSpreadsheet(latency=args.sheets_latency / 1000)
+    spreadsheet.add("countries", [["country", "code"], ["united states", "US"], ["sweden", "SE"]])
+    watch_lists = make_watch_lists(args, apps)
+    bot = FakeBot(asyncio.get_event_loop(), dm_latency=args.dm_latency / 1000)
+    cog = Service(bot, spreadsheet=spreadsheet)
+    cog.appstore.backoff = 0.01
+    if isinstance(cog.store.backend, SQLiteStore):
+        for user_id, rows in watch_lists.items():
+            await cog.store.backend.add_user(user_id)
+            for row in rows:
+                await cog.store.backend.add_entry(user_id, dict(zip(HEADER, row)))
+    else:
+        for user_id, rows in watch_lists.items():
+            spreadsheet.add(user_id, [HEADER] + rows)
+
+    print("{} users x {} apps, {} distinct, {} store, {}ms App Store / {}ms Sheets latency, {:.0%} errors".format(
+        args.users, args.apps, len({row[0] for rows in watch_lists.values() for row in rows}), args.store, args.latency, args.sheets_latency, args.error_rate))
+    try:
+        with Run("sweep", appstore, spreadsheet, bot):
+            await sweep(cog)
+        users = random.Random(args.seed).sample(sorted(watch_lists), min(args.commands, len(watch_lists)))
+        version_cache.clear()
+        with Run("watch", appstore, spreadsheet, bot):
+            for user_id in users:
+                await Service.watch.callback(cog, FakeContext(bot, bot.get_user(int(user_id))))
+        with Run("add", appstore, spreadsheet, bot):
+            for user_id in users:
+                extra = [app["bundleId"] for app in apps[-10:]]
+                await Service.add.callback(cog, FakeContext(bot, bot.get_user(int(user_id))), *extra)
+        with Run("search", appstore, spreadsheet, bot):
+            for user_id in users:
+                await Service.search.callback(cog, FakeContext(bot, bot.get_user(int(user_id))), "bench app 1")
+    finally:
+        await cog.appstore.close()
+        await cog.store.close()
+        await appstore.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--apps", type=int, default=20, help="apps per user")
+    parser.add_argument("--overlap", type=float, default=0.5, help="0 = every row a different app, 1 = everyone watches the same M apps")
+    parser.add_argument("--outdated", type=float, default=0.1, help="fraction of rows behind the store's version")
+    parser.add_argument("--latency", type=float, default=50, help="App Store latency in ms")
+    parser.add_argument("--appstore-rate", type=float, default=1000, help="App Store requests per second allowed by the limiter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of App Store requests answered with 503")
+    parser.add_argument("--sheets-latency", type=float, default=20, help="latency of each Sheets call in ms")
+    parser.add_argument("--dm-latency", type=float, default=10, help="latency of each DM in ms")
+    parser.add_argument("--store", choices=["sheets", "sqlite"], default="sheets")
+    parser.add_argument("--commands", type=int, default=20, help="users running watch and add")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main(parse_args()))
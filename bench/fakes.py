@@ -0,0 +1,261 @@
+""" Offline stand-ins for the App Store, Google Sheets and Discord used by the benchmarks """
+import asyncio
+import random
+import socket
+import threading
+import time
+
+import gspread
+from gspread.utils import a1_to_rowcol, cell_list_to_rect, rowcol_to_a1
+from aiohttp import web
+
+
+class FakeAppStore:
+    """ Local aiohttp server answering /<country>/lookup and /search like itunes.apple.com """
+    def __init__(self, apps, latency=0.05, error_rate=0.0):
+        self.apps = {app["bundleId"].lower(): app for app in apps}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = {"lookup": 0, "search": 0}
+        self.errors = 0
+        self.runner = None
+        self.port = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.port)
+
+    async def _respond(self, endpoint, results):
+        self.requests[endpoint] += 1
+        await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        return web.json_response({"resultCount": len(results), "results": results}, content_type="text/javascript")
+
+    async def lookup(self, request):
+        bundle_ids = request.query.get("bundleId", "").split(",")
+        return await self._respond("lookup", [self.apps[bundle_id.lower()] for bundle_id in bundle_ids if bundle_id.lower() in self.apps])
+
+    async def search(self, request):
+        term = request.query.get("term", "").lower()
+        return await self._respond("search", [app for app in self.apps.values() if term in app["trackName"].lower()][:50])
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/{country}/lookup", self.lookup)
+        app.router.add_get("/search", self.search)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeWorksheet:
+    """ In-memory gspread Worksheet, implementing the calls the store makes """
+    def __init__(self, spreadsheet, title, rows=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = [list(row) for row in rows or []]
+
+    def _call(self, method):
+        self.spreadsheet.call(method)
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        return [list(row) for row in self.rows]
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        return [dict(zip(self.rows[0], row)) for row in self.rows[1:]]
+
+    def find(self, query):
+        self._call("find")
+        for row, values in enumerate(self.rows, start=1):
+            for col, value in enumerate(values, start=1):
+                if value == query:
+                    return FakeCell(row, col, value)
+        raise gspread.exceptions.CellNotFound(query)
+
+    def row_values(self, row):
+        self._call("row_values")
+        return list(self.rows[row - 1])
+
+    def append_row(self, values):
+        self._call("append_row")
+        self.rows.append([str(value) for value in values])
+
+    def delete_row(self, index):
+        self._call("delete_row")
+        del self.rows[index - 1]
+
+    def update_cells(self, cells, value_input_option="RAW"):
+        """ Same rectangle gspread 3.1 sends, offset by the first cell's column like it is """
+        self._call("update_cells")
+        start = rowcol_to_a1(min(cell.row for cell in cells), min(cell.col for cell in cells))
+        end = rowcol_to_a1(max(cell.row for cell in cells), max(cell.col for cell in cells))
+        self.spreadsheet.write("{}!{}:{}".format(self.title, start, end), cell_list_to_rect(cells))
+
+    def write(self, top, left, values):
+        """ Write a value rectangle, skipping None like the Sheets API """
+        for row, row_values in enumerate(values, start=top):
+            while len(self.rows) < row:
+                self.rows.append([])
+            for col, value in enumerate(row_values, start=left):
+                if value is None:
+                    continue
+                cells = self.rows[row - 1]
+                cells.extend([""] * (col - len(cells)))
+                cells[col - 1] = str(value)
+
+
+class FakeSpreadsheet:
+    """ In-memory gspread Spreadsheet; every call sleeps `latency` seconds, like a blocking HTTP request """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._worksheets = []
+
+    def call(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add(self, title, rows):
+        """ Set up a worksheet without counting it as a call """
+        worksheet = FakeWorksheet(self, title, rows)
+        self._worksheets.append(worksheet)
+        return worksheet
+
+    def worksheets(self):
+        self.call("worksheets")
+        return list(self._worksheets)
+
+    def worksheet(self, title):
+        self.call("worksheet")
+        for worksheet in self._worksheets:
+            if worksheet.title == title:
+                return worksheet
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def write(self, range, values):
+        title, cells = range.rsplit("!", 1)
+        if title.startswith("'"):
+            title = title[1:-1].replace("''", "'")
+        top, left = a1_to_rowcol(cells.split(":")[0])
+        for worksheet in self._worksheets:
+            if worksheet.title == title:
+                worksheet.write(top, left, values)
+
+    def values_update(self, range, params, body):
+        self.call("values_update")
+        self.write(range, body["values"])
+
+    def values_append(self, range, params, body):
+        self.call("values_append")
+        for worksheet in self._worksheets:
+            if worksheet.title == range:
+                worksheet.rows.extend([str(value) for value in row] for row in body["values"])
+
+    def add_worksheet(self, title, rows, cols):
+        self.call("add_worksheet")
+        return self.add(title, [])
+
+
+class FakeUser:
+    def __init__(self, id, latency=0.0):
+        self.id = id
+        self.name = "user{}".format(id)
+        self.avatar_url = ""
+        self.latency = latency
+        self.sent = 0
+
+    async def send(self, content=None, embed=None):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return FakeMessage()
+
+
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self):
+        FakeMessage._ids += 1
+        self.id = FakeMessage._ids
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, user):
+        pass
+
+    async def clear_reactions(self):
+        pass
+
+
+class FakeChannel:
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+        return FakeMessage()
+
+
+class FakeBot:
+    """ Just enough of commands.Bot for the Service cog; reaction waits time out immediately """
+    def __init__(self, loop, dm_latency=0.0):
+        self.loop = loop
+        self.dm_latency = dm_latency
+        self.users = {}
+        self.user = FakeUser(0)
+
+    def get_user(self, id):
+        if id not in self.users:
+            self.users[id] = FakeUser(id, self.dm_latency)
+        return self.users[id]
+
+    async def fetch_user(self, id):
+        return self.get_user(id)
+
+    async def wait_for(self, event, timeout=None, check=None):
+        raise asyncio.TimeoutError
+
+    def get_command(self, name):
+        return None
+
+    @property
+    def dms_sent(self):
+        return sum(user.sent for user in self.users.values())
+
+
+class FakeMessageContext:
+    def __init__(self, author):
+        self.author = author
+        self.attachments = []
+
+
+class FakeContext:
+    def __init__(self, bot, author):
+        self.bot = bot
+        self.message = FakeMessageContext(author)
+        self.author = author
+        self.channel = FakeChannel()
+        self.guild = None
@@ -11,7 +11,12 @@ import datetime
 #https://discordapp.com/oauth2/authorize?client_id=593029590205726735&scope=bot&permissions=8
 
 
-class Bot(commands.Bot):
+# with config.sharded the gateway is split over shards, optionally only config.shard_ids
+# of config.shard_count in this process so several processes can share the load
+BotBase = commands.AutoShardedBot if getattr(config, "sharded", False) else commands.Bot
+
+
+class Bot(BotBase):
     def __init__(self, **kwargs):
         super().__init__(command_prefix=commands.when_mentioned_or('.'), case_insensitive=True, **kwargs) #, formatter = CustomFormatter()
         self.remove_command('help')
@@ -27,7 +32,13 @@ class Bot(commands.Bot):
         print('Logged on as {0} (ID: {0.id})'.format(self.user))
 
 
-bot = Bot()
+sharding = {}
+if getattr(config, "sharded", False):
+    if getattr(config, "shard_count", None):
+        sharding["shard_count"] = config.shard_count
+    if getattr(config, "shard_ids", None):
+        sharding["shard_ids"] = config.shard_ids
+bot = Bot(**sharding)
 
 
 @bot.command(
@@ -40,6 +51,8 @@ async def help(ctx):
     embed = discord.Embed(colour=0x95a5a6, description="For more information, refer to [this](https://kevinissa.dev/appmonitor.html).")
     embed.set_author(name="Help")
     for command in bot.cogs["Service"].get_commands():
+        if command.hidden:
+            continue
         embed.add_field(name=command.name, value=command.description, inline=False)
     embed.set_footer(text="Use \".more <command>\" for the syntax of a command.")
     await ctx.channel.send(embed=embed)
@@ -2,13 +2,39 @@ import discord
 from discord.ext import commands
 import asyncio
 import os
-import json
-import aiohttp
+import socket
+import sys
+import time
+import traceback
+import datetime
 import gspread
+import httplib2
 from oauth2client.service_account import ServiceAccountCredentials as sac
+import config
+from .utils.appstore import AppStoreClient, AppStoreError, version_cache, search_cache, chunked, LOOKUP_CHUNK_SIZE, requests_total, request_seconds
+from .utils.index import SubscriberIndex
+from .utils.store import HEADER, CachedStore, SheetStore, SQLiteStore, migrate as migrate_store, run_sheets, sheets_calls
+from .utils.monitor import LoopLagMonitor
+from .utils.scheduler import PollScheduler
+from .utils.ratelimit import KeyedTokenBucket, PriorityLimiter
+from .utils.countries import CountryResolver
+from .utils.cluster import Cluster
+from .utils.metrics import metrics, MetricsServer
+from .utils.digest import Digests, QuietWindows
+
+MAX_ENTRIES = 50
+# updates per digest embed page
+DIGEST_PAGE_SIZE = 10
+
+lookup_seconds = metrics.histogram("appmonitor_lookup_seconds", "Service.lookup_many latency, cache hits included")
+sweep_seconds = metrics.histogram("appmonitor_sweep_seconds", "Time for a notify() sweep to check every due application and queue the digests", buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+check_seconds = metrics.histogram("appmonitor_check_seconds", "Time to look up and reschedule one batch of due applications")
+checks_total = metrics.counter("appmonitor_checks_total", "Application checks by outcome", ["outcome"])
+dms_total = metrics.counter("appmonitor_dms_total", "Update DMs by result", ["result"])
+updates_total = metrics.counter("appmonitor_updates_notified_total", "Updates delivered in digest DMs")
 
 class Service(commands.Cog):
-    def __init__(self, bot):
+    def __init__(self, bot, spreadsheet=None):
         self.bot = bot
         self.scope = [
             "https://spreadsheets.google.com/feeds",
@@ -16,9 +42,106 @@ class Service(commands.Cog):
             "https://www.googleapis.com/auth/drive.file",
             "https://www.googleapis.com/auth/drive"
             ]
-        self.creds = sac.from_json_keyfile_name("creds.json", self.scope)
-        self.client = gspread.authorize(self.creds)
-        self.spreadsheet = self.client.open("AppMonitor") # .get_worksheet(1)
+        # opened by start() for the sheets store, or by .migrate, so loading the cog doesn't wait on Google
+        self.creds = None
+        self.client = None
+        self.spreadsheet = spreadsheet
+        self.spreadsheet_lock = asyncio.Lock()
+        self.ready = asyncio.Event()
+        if getattr(config, "store", "sheets") == "sqlite":
+            self.store = CachedStore(SQLiteStore(getattr(config, "database", "appmonitor.db")))
+        else:
+            self.store = CachedStore(SheetStore(self.spreadsheet))
+        version_cache.configure(ttl=getattr(config, "version_cache_ttl", 60), maxsize=getattr(config, "version_cache_size", 4096))
+        search_cache.configure(ttl=getattr(config, "search_cache_ttl", 60*5), maxsize=getattr(config, "search_cache_size", 256))
+        # every App Store request, interactive commands ahead of the notify() sweep
+        self.appstore_limiter = PriorityLimiter(
+            rate=getattr(config, "appstore_rate", 5),
+            capacity=getattr(config, "appstore_burst", 10),
+            )
+        self.appstore = AppStoreClient(base_url=getattr(config, "appstore_url", "https://itunes.apple.com"), limiter=self.appstore_limiter)
+        self.index = SubscriberIndex()
+        self.countries = CountryResolver()
+        # several processes can split polling between them through a shared cluster directory
+        self.cluster = None
+        if getattr(config, "cluster_dir", None):
+            if not isinstance(self.store.backend, SQLiteStore):
+                raise RuntimeError("running as a cluster needs config.store = \"sqlite\"")
+            # unique per process, several workers may run on one host. Set config.worker_id
+            # to keep the same identity, and poll state snapshot, across restarts
+            self.cluster = Cluster(getattr(config, "worker_id", "{}-{}".format(socket.gethostname(), os.getpid())), config.cluster_dir)
+            # a per-process identity would never be restored, just leave a new file behind every start
+            default_snapshot = "pollstate-{}.bin".format(config.worker_id) if getattr(config, "worker_id", None) else None
+            self.snapshot_path = getattr(config, "snapshot_path", default_snapshot)
+            if self.snapshot_path is None:
+                print("[*] Set config.worker_id to keep poll state across restarts")
+            self.quiet = QuietWindows(getattr(config, "quiet_path", os.path.join(config.cluster_dir, "quiet.json")))
+        else:
+            self.snapshot_path = getattr(config, "snapshot_path", "pollstate.bin")
+            self.quiet = QuietWindows(getattr(config, "quiet_path", "quiet.json"))
+        self.quiet.load()
+        self.scheduler = PollScheduler(
+            min_interval=getattr(config, "poll_min_interval", 60),
+            max_interval=getattr(config, "poll_max_interval", 60*60*6),
+            initial_interval=getattr(config, "poll_initial_interval", 60*3),
+            # an app updating every poll_reference_period is polled every poll_reference_interval
+            reference_period=getattr(config, "poll_reference_period", 60*60*24*7),
+            reference_interval=getattr(config, "poll_reference_interval", 60*3),
+            exponent=getattr(config, "poll_exponent", 0.5),
+            )
+        self.lag_monitor = LoopLagMonitor()
+        # notify() pipeline: due apps -> version checks -> change detection -> DMs
+        self.check_workers = getattr(config, "check_workers", 4)
+        self.dm_workers = getattr(config, "dm_workers", 4)
+        self.check_queue = asyncio.Queue(maxsize=self.check_workers * 2)
+        self.change_queue = asyncio.Queue(maxsize=100)
+        self.dm_queue = asyncio.Queue(maxsize=100)
+        self.in_flight = set()
+        # updates found by a sweep wait here, so each user gets one DM for all of them
+        self.digests = Digests()
+        # Discord allows about 5 messages per 5 seconds per DM channel
+        self.dm_limiter = KeyedTokenBucket(rate=1, capacity=5, global_rate=20, global_capacity=20)
+        self.metrics_server = MetricsServer(metrics, port=getattr(config, "metrics_port", 9108))
+        self.register_metrics()
+        self.tasks = []
+
+    def register_metrics(self):
+        """ Gauges read from the cog's state whenever metrics are collected """
+        queues = {"check": self.check_queue, "change": self.change_queue, "dm": self.dm_queue}
+        metrics.gauge("appmonitor_queue_depth", "Items waiting in each notify() pipeline queue", lambda: {(name,): queue.qsize() for name, queue in queues.items()}, ["queue"])
+        metrics.gauge("appmonitor_notifications_in_flight", "Notifications detected but not yet sent", lambda: len(self.in_flight))
+        metrics.gauge("appmonitor_digest_updates", "Updates waiting for their user's next digest", lambda: len(self.digests))
+        metrics.gauge("appmonitor_scheduled_apps", "Applications this process is polling", lambda: len(self.scheduler))
+        metrics.gauge("appmonitor_watched_apps", "Distinct watched (bundle_id, country) pairs", lambda: len(self.index))
+        metrics.gauge("appmonitor_version_cache", "Version cache size and lookups", lambda: {(name,): value for name, value in version_cache.stats().items()}, ["stat"])
+        metrics.gauge("appmonitor_search_cache", "Search cache size and lookups", lambda: {(name,): value for name, value in search_cache.stats().items()}, ["stat"])
+        metrics.gauge("appmonitor_appstore_limiter", "App Store limiter rate, waiters and throttled requests per lane", lambda: {(lane, stat): value for lane, stats in self.appstore_limiter.state()[1].items() for stat, value in stats.items()}, ["lane", "stat"])
+        metrics.gauge("appmonitor_appstore_limiter_tokens", "Tokens left in the shared App Store bucket", lambda: self.appstore_limiter.state()[0])
+        metrics.gauge("appmonitor_loop_lag_seconds", "Event loop lag in the current minute", lambda: dict(zip([("worst",), ("p99",)], self.lag_monitor.current())), ["stat"])
+
+    def cog_unload(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.snapshot_path and len(self.scheduler):
+            self.scheduler.snapshot(self.snapshot_path)
+        if self.cluster:
+            self.cluster.leave()
+        self.bot.loop.create_task(self.appstore.close())
+        self.bot.loop.create_task(self.store.close())
+        self.bot.loop.create_task(self.metrics_server.stop())
+
+    async def cog_check(self, ctx):
+        # commands wait until start() has warmed the caches
+        await self.ready.wait()
+        return True
+
+    async def cog_command_error(self, ctx, error):
+        if isinstance(error, commands.CommandInvokeError) and isinstance(error.original, AppStoreError):
+            await ctx.channel.send(embed=await self.error_embed(description="Couldn't reach the App Store, try again later!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url))
+        elif not hasattr(ctx.command, "on_error"):
+            # having this handler stops the bot's default one, which would have printed it
+            print("Ignoring exception in command {}:".format(ctx.command), file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
 
     async def error_embed(self, title=None, description=None, author=None, author_url=None, author_icon=None, footer=None):
         embed = discord.Embed(color=0xe74c3c)
@@ -40,97 +163,465 @@ class Service(commands.Cog):
         return embed
 
 
+    async def lookup(self, bundle_id, country):
+        """ Look up bundle ID in appropriate store, served from the shared version cache """
+        return (await self.lookup_many([(bundle_id, country)]))[(bundle_id, country)]
+
+
+    async def lookup_many(self, pairs, lane="interactive"):
+        """ Look up many (bundle_id, country) pairs, batched per country, returns {pair: info} """
+        async def fetch_chunk(country, bundle_ids):
+            found = await self.appstore.lookup(bundle_ids, country, lane)
+            return {(bundle_id, country): found[bundle_id] for bundle_id in bundle_ids}
+
+        async def fetch(pairs):
+            by_country = {}
+            for bundle_id, country in pairs:
+                by_country.setdefault(country, []).append(bundle_id)
+            requests = [fetch_chunk(country, chunk) for country, bundle_ids in by_country.items() for chunk in chunked(bundle_ids, LOOKUP_CHUNK_SIZE)]
+            results = {}
+            for chunk in await asyncio.gather(*requests):
+                results.update(chunk)
+            return results
+        with lookup_seconds.time():
+            return await version_cache.get_many(pairs, fetch)
+
+
+    async def search_apps(self, term, country):
+        """ Search the App Store, served from the search cache. Fresh results also go into
+        the version cache, for as long as the search is cached, so adding one of them
+        doesn't look it up again even when the search itself was a cache hit """
+        async def fetch():
+            results = (await self.appstore.search(term, country))["results"]
+            for app in results:
+                version_cache.put(app["bundleId"], country, app, ttl=search_cache.ttl)
+            return results
+        return await search_cache.get(term, country, fetch)
+
+
     async def fetch_version(self, bundle_id, country):
         """ Fetch the latest version of bundle ID from appropriate store """
-        info_url = "https://itunes.apple.com/" + country + "/lookup?bundleId=" + bundle_id
-        async with aiohttp.ClientSession() as session:
-            async with session.get(info_url) as resp:
-                info = json.loads(await resp.read())
-        return info['results'][0]['version']
-
-
-    async def add_entry(self, ctx, id, bundle_id, country):
-        """ Add an entry """
-        if len(self.spreadsheet.worksheet(id).get_all_records()) > 49:
-            await ctx.channel.send(embed=await self.error_embed(description="You've exceeded the maximum amount of applications!", author=ctx.message.author, author_icon=ctx.message.author.avatar_url))
-            return False
-        try:
-            self.spreadsheet.worksheet(id).find(bundle_id)
-            await ctx.channel.send(embed=await self.error_embed(description="You've already added that application!", author=ctx.message.author, author_icon=ctx.message.author.avatar_url))
-            return False
-        except gspread.exceptions.CellNotFound:
-            pass
-        info_url = "https://itunes.apple.com/" + country + "/lookup?bundleId=" + bundle_id
-        async with aiohttp.ClientSession() as session:
-            async with session.get(info_url) as resp:
-                info = json.loads(await resp.read())
-        if info['resultCount'] == 1:
-            self.spreadsheet.worksheet(id).append_row([
-                bundle_id,
-                info['results'][0]['trackName'],
-                info['results'][0]['version'],
-                country,
-                info['results'][0]['artworkUrl512'],
-                info['results'][0]['trackViewUrl'],
-                "0"
-                ])
-            return info
+        info = await self.lookup(bundle_id, country)
+        if info:
+            return info['version']
+
+
+    async def add_entries(self, id, bundle_ids, country):
+        """ Add entries with one read of the watch-list, one batched lookup and one write.
+        Returns [(bundle_id, status, info)] in request order, status being "added",
+        "duplicate", "not_found" or "limit" """
+        entries = await self.store.entries(id)
+        existing = {entry["bundle_id"] for entry in entries}
+        # only look up as many as could fit, a long attachment shouldn't cost lookups that can't be added
+        room = MAX_ENTRIES - len(entries)
+        wanted = []
+        statuses = []
+        for bundle_id in bundle_ids:
+            if bundle_id in existing:
+                statuses.append((bundle_id, "duplicate"))
+            elif len(wanted) >= room:
+                statuses.append((bundle_id, "limit"))
+            else:
+                existing.add(bundle_id)
+                wanted.append(bundle_id)
+                statuses.append((bundle_id, None))
+        latest = await self.lookup_many([(bundle_id, country) for bundle_id in wanted]) if wanted else {}
+        new_entries = []
+        results = []
+        for bundle_id, status in statuses:
+            info = latest.get((bundle_id, country)) if status is None else None
+            if status is None:
+                if not info:
+                    status = "not_found"
+                else:
+                    status = "added"
+                    new_entries.append(dict(zip(HEADER, [
+                        bundle_id,
+                        info['trackName'],
+                        info['version'],
+                        country,
+                        info['artworkUrl512'],
+                        info['trackViewUrl'],
+                        "0"
+                        ])))
+            results.append((bundle_id, status, info))
+        if new_entries:
+            await self.store.add_entries(id, new_entries)
+            for entry in new_entries:
+                self.index.add(id, entry)
+        return results
 
 
     async def add_user(self, id):
-        self.spreadsheet.add_worksheet(title=id, rows="0", cols="0")
-        self.spreadsheet.worksheet(id).append_row(["bundle_id", "name", "version", "country", "icon", "url", "notified"])
+        await self.store.add_user(id)
 
 
     async def remove_entry(self, id, bundle_id):
         """ Remove an entry """
-        try:
-            cell = self.spreadsheet.worksheet(id).find(bundle_id)
-        except gspread.exceptions.CellNotFound:
-            return
-        info = self.spreadsheet.worksheet(id).row_values(cell.row)
-        self.spreadsheet.worksheet(id).delete_row(cell.row)
-        return info
+        entry = await self.store.remove_entry(id, bundle_id)
+        if entry:
+            self.index.remove(id, entry["bundle_id"], entry["country"])
+            self.forget_notification(id, entry)
+        return entry
 
 
     async def update_entry(self, id, bundle_id):
         """ Update the local version of an entry """
+        entry = await self.store.find_entry(id, bundle_id)
+        if not entry:
+            return
+        version = await self.fetch_version(bundle_id, entry["country"])
+        if version is None:
+            return
+        entry = await self.store.update_entry(id, bundle_id, version=version, notified=0)
+        self.index.update(id, entry)
+        self.forget_notification(id, entry)
+        return entry
+
+
+    def forget_notification(self, id, entry):
+        """ Drop an update still waiting in the user's digest, the user has dealt with the app already """
+        key = self.index.key(entry["bundle_id"], entry["country"])
+        self.digests.discard(id, key)
+        self.in_flight.discard((id, key))
+
+
+    async def resolve_country(self, text):
+        """ Store code for a country name, code or alias, None if there's no such country """
+        if not self.countries.loaded:
+            await self.countries.refresh(self.store)
+        return self.countries.resolve(text)
+
+
+    async def build_index(self):
+        """ Build the subscriber index from every user's watch-list """
+        self.index.rebuild([(user_id, await self.store.entries(user_id)) for user_id in await self.store.users()])
+
+
+    async def check_versions(self):
+        """ Pipeline stage: look up batches of due apps and reschedule them """
+        while True:
+            keys = await self.check_queue.get()
+            started = time.perf_counter()
+            try:
+                try:
+                    latest = await self.lookup_many(keys, lane="background")
+                except asyncio.CancelledError:
+                    # an Exception before Python 3.8
+                    raise
+                except Exception as exc:
+                    print("[!] Lookup failed, retrying later: {!r}".format(exc))
+                    checks_total.inc("failed", amount=len(keys))
+                    for key in keys:
+                        self.scheduler.retry(key)
+                    continue
+                for key in keys:
+                    # one bad result mustn't take the batch, or the worker, down with it
+                    try:
+                        info = latest.get(key)
+                        self.scheduler.record(key, info)
+                        checks_total.inc("ok" if info else "not_found")
+                        if info:
+                            await self.change_queue.put((key, info))
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as exc:
+                        print("[!] Couldn't check {}: {!r}".format(key, exc))
+                        checks_total.inc("failed")
+                        self.scheduler.retry(key)
+                check_seconds.observe(time.perf_counter() - started)
+            finally:
+                # only once the batch's changes are queued, so joining both queues means the sweep was checked
+                self.check_queue.task_done()
+
+
+    async def detect_changes(self):
+        """ Pipeline stage: add an update to the digest of every subscriber whose acknowledged version differs """
+        while True:
+            key, info = await self.change_queue.get()
+            try:
+                for user_id, application in list(self.index.subscribers(*key).items()):
+                    if application["notified"] == 0 and info['version'] != application["version"]:
+                        if (user_id, key) not in self.in_flight:
+                            self.in_flight.add((user_id, key))
+                            self.digests.add(user_id, key, application, info)
+                        else:
+                            self.digests.refresh(user_id, key, info)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print("[!] Couldn't detect changes for {}: {!r}".format(key, exc))
+                self.scheduler.retry(key)
+            finally:
+                self.change_queue.task_done()
+
+
+    async def queue_digests(self):
+        """ Hand the digests of users outside their quiet window to the DM stage """
+        for user_id, updates in self.digests.pop_due(self.quiet):
+            await self.dm_queue.put((user_id, updates))
+
+
+    def digest_pages(self, updates):
+        """ Digest embeds, DIGEST_PAGE_SIZE updates each """
+        pages = list(chunked(sorted(updates, key=lambda update: update[1]['name'].lower()), DIGEST_PAGE_SIZE))
+        embeds = []
+        for page, chunk in enumerate(pages):
+            if len(updates) == 1:
+                key, application, info = chunk[0]
+                embed = discord.Embed(title="Update Available!", color=0x1C89F5)
+                embed.set_author(name=application['name'], url=application['url'], icon_url=application['icon'])
+                embed.set_footer(text="Latest version: v" + info['version'])
+            else:
+                embed = discord.Embed(title="{} Updates Available!".format(len(updates)), color=0x1C89F5)
+                for key, application, info in chunk:
+                    embed.add_field(name=application['name'], value="[{}]({})  |  v{} \u2192 v{}".format(application['bundle_id'], application['url'], application['version'], info['version']), inline=False)
+                if len(pages) > 1:
+                    embed.set_footer(text="Page {}/{}".format(page+1, len(pages)))
+            embeds.append(embed)
+        return embeds
+
+
+    async def digest_session(self, user, msg, pages):
+        """ Page through a long digest. Bots can't remove reactions in DMs, so adding or removing one both turn the page """
+        back_emoji = "\U00002b05"
+        forward_emoji = "\U000027a1"
+        page = 0
+        def check(reaction, reactor):
+            return reactor.id == user.id and reaction.message.id == msg.id and str(reaction.emoji) in (back_emoji, forward_emoji)
+        while True:
+            waits = [self.bot.loop.create_task(self.bot.wait_for(event, check=check)) for event in ('reaction_add', 'reaction_remove')]
+            done, pending = await asyncio.wait(waits, timeout=60*10, return_when=asyncio.FIRST_COMPLETED)
+            for wait in pending:
+                wait.cancel()
+            if not done:
+                return
+            reaction, reactor = done.pop().result()
+            if str(reaction.emoji) == forward_emoji:
+                page = min(page + 1, len(pages) - 1)
+            else:
+                page = max(page - 1, 0)
+            await msg.edit(embed=pages[page])
+
+
+    async def dispatch_notifications(self):
+        """ Pipeline stage: claim updates in the store, then send their digest DMs within Discord's rate limits """
+        while True:
+            user_id, updates = await self.dm_queue.get()
+            claimed = []
+            try:
+                claimed = await self.claim_notifications(user_id, updates)
+                if not claimed:
+                    continue
+                # users that share no guild with this process's shards aren't cached
+                user = self.bot.get_user(int(user_id)) or await self.bot.fetch_user(int(user_id))
+                pages = self.digest_pages(claimed)
+                await self.dm_limiter.acquire(user_id)
+                try:
+                    msg = await user.send(embed=pages[0])
+                    if len(pages) > 1:
+                        await msg.add_reaction("\U00002b05")
+                        await msg.add_reaction("\U000027a1")
+                        self.tasks = [task for task in self.tasks if not task.done()]
+                        self.tasks.append(self.bot.loop.create_task(self.digest_session(user, msg, pages)))
+                    dms_total.inc("sent")
+                    updates_total.inc(amount=len(claimed))
+                except discord.Forbidden:
+                    # DMs are closed, keep the claims so we don't retry every check
+                    print("[!] Can't DM", user_id)
+                    dms_total.inc("forbidden")
+                except discord.HTTPException as exc:
+                    print("[!] Couldn't notify {}: {}".format(user_id, exc))
+                    dms_total.inc("failed")
+                    await self.release_notifications(user_id, claimed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print("[!] Couldn't notify {}: {!r}".format(user_id, exc))
+                dms_total.inc("failed")
+                await self.release_notifications(user_id, claimed)
+            finally:
+                for key, application, info in updates:
+                    self.in_flight.discard((user_id, key))
+                self.dm_queue.task_done()
+
+
+    async def claim_notifications(self, user_id, updates):
+        """ Mark updates notified before they're sent, returns the ones this process claimed.
+        Another worker may have sent some since our watch-lists were loaded, e.g. the
+        previous owner of an app before a rebalance; those are skipped, as are entries
+        the user updated while the digest was waiting """
+        claimed = []
+        for key, application, info in updates:
+            entry = await self.store.mark_notified(user_id, application["bundle_id"], application["version"])
+            if entry:
+                claimed.append((key, application, info))
+            else:
+                entry = await self.store.find_entry(user_id, application["bundle_id"])
+            if entry:
+                # reconcile() may have replaced `application` in the index since
+                self.index.update(user_id, entry)
+        return claimed
+
+
+    async def release_notifications(self, user_id, updates):
+        """ Give back the claims on updates that couldn't be sent, so the next sweep retries them """
+        for key, application, info in updates:
+            try:
+                entry = await self.store.mark_notified(user_id, application["bundle_id"], application["version"], notified=0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print("[!] Couldn't release {} for {}: {}".format(application["bundle_id"], user_id, exc))
+                continue
+            if entry:
+                self.index.update(user_id, entry)
+
+
+    def owns(self, key):
+        """ Whether this process polls key """
+        return self.cluster is None or self.cluster.owns(key)
+
+
+    async def start_metrics_server(self):
+        # workers on one host take the next free ports after metrics_port
+        attempts = getattr(config, "metrics_port_range", 16) if self.cluster else 1
         try:
-            cell = self.spreadsheet.worksheet(id).find(bundle_id)
-        except gspread.exceptions.CellNotFound:
+            await self.metrics_server.start(attempts)
+        except OSError as exc:
+            print("[!] Could not serve metrics:", exc)
             return
-        version = await self.fetch_version(bundle_id, self.spreadsheet.worksheet(id).cell(cell.row, 4).value)
-        self.spreadsheet.worksheet(id).update_cell(cell.row, 3, "'" + version)
-        self.spreadsheet.worksheet(id).update_cell(cell.row, 7, "'" + "0")
-        return self.spreadsheet.worksheet(id).row_values(cell.row)
+        print("[*] Serving metrics on port", self.metrics_server.port)
+        if self.cluster:
+            self.cluster.info["metrics_port"] = self.metrics_server.port
+
+
+    async def snapshot_poll_state(self):
+        """ Periodically save the scheduler's state so a restart resumes where it left off """
+        while True:
+            await asyncio.sleep(getattr(config, "snapshot_interval", 60))
+            try:
+                self.scheduler.snapshot(self.snapshot_path)
+            except OSError as exc:
+                print("[!] Could not save poll state:", exc)
+
+
+    async def open_spreadsheet(self):
+        """ Authorize with Google and open the spreadsheet, once; keeps the token fresh from then on """
+        async with self.spreadsheet_lock:
+            if self.spreadsheet is None:
+                self.creds = await run_sheets(sac.from_json_keyfile_name, "creds.json", self.scope)
+                self.client = await run_sheets(gspread.authorize, self.creds)
+                self.spreadsheet = await run_sheets(self.client.open, "AppMonitor")
+                if isinstance(self.store.backend, SheetStore):
+                    self.store.backend.spreadsheet = self.spreadsheet
+                self.tasks.append(self.bot.loop.create_task(self.refresh_token()))
+        return self.spreadsheet
+
+
+    async def start(self):
+        """ Open the spreadsheet if it's the store, warm the watch-list, country and subscriber caches, then accept commands """
+        while True:
+            try:
+                # a local database needs nothing from Google to serve commands
+                if isinstance(self.store.backend, SheetStore):
+                    await self.open_spreadsheet()
+                await self.countries.refresh(self.store)
+                await self.build_index()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print("[!] Startup failed, retrying in 30 seconds:", exc)
+                await asyncio.sleep(30)
+                continue
+            break
+        self.ready.set()
+        print("[*] Service ready,", len(self.index), "applications watched")
+
+
+    def start_pipeline(self):
+        """ Start the notify() pipeline stages, returns their tasks """
+        stages = [self.check_versions] * self.check_workers + [self.detect_changes] + [self.dispatch_notifications] * self.dm_workers
+        tasks = [self.bot.loop.create_task(stage()) for stage in stages]
+        self.tasks.extend(tasks)
+        return tasks
+
+
+    async def run_sweep(self, now=None, spread=None):
+        """ One notify() pass: check every app that's due and hand the resulting digests
+        to the DM stage. Returns the number of apps checked """
+        # apps whose subscribers have all been notified need no polling until someone updates
+        # notified apps keep their update history for when someone acknowledges them
+        self.scheduler.sync([key for key in self.index.pending() if self.owns(key)], spread, keep=[key for key, subscribers in self.index.items() if self.owns(key)])
+        started = time.perf_counter()
+        due = self.scheduler.pop_due(now)
+        for keys in chunked(due, LOOKUP_CHUNK_SIZE):
+            # blocks while the checkers are behind
+            await self.check_queue.put(keys)
+        if due:
+            # let the sweep finish so its updates go out as one digest per user
+            await self.check_queue.join()
+            await self.change_queue.join()
+        await self.queue_digests()
+        if due:
+            # passes with nothing due would drown out the real sweeps
+            sweep_seconds.observe(time.perf_counter() - started)
+        return len(due)
 
 
     async def notify(self):
-        await asyncio.sleep(5)
+        await self.bot.wait_until_ready()
+        await self.ready.wait()
+        if self.snapshot_path:
+            restored = self.scheduler.restore(self.snapshot_path)
+            if restored:
+                print("[*] Restored poll state for", restored, "applications")
+            self.tasks.append(self.bot.loop.create_task(self.snapshot_poll_state()))
+        self.start_pipeline()
         while True:
-            for user in self.spreadsheet.worksheets()[1:]:
-                for application in user.get_all_records():
-                    if application["notified"] == 0:
-                        latest_version = await self.fetch_version(application["bundle_id"], application['country'])
-                        if latest_version != str(application["version"]):
-                            embed = discord.Embed(title="Update Available!", color=0x1C89F5)
-                            embed.set_author(name=application['name'], url=application['url'], icon_url=application['icon'])
-                            embed.set_footer(text="Latest version: v" + latest_version)
-                            # a = self.bot.get_user(int(user))
-                            # print(a)
-                            await self.bot.get_user(int(user.title)).send(embed=embed)
-                            cell = user.find(application["bundle_id"])
-                            user.update_cell(cell.row, 7, "'" + "1")
-            await asyncio.sleep(60*3)
-
-
-    async def refresh_token(self):
+            await self.run_sweep()
+            next_due = self.scheduler.next_due()
+            await asyncio.sleep(min(next_due if next_due is not None else 30, 30))
+
+
+    async def refresh_token(self, margin=300):
+        """ Refresh the access token `margin` seconds before it expires. The client and
+        spreadsheet are kept; login() only swaps the session's Authorization header, so
+        requests already in flight carry on with the old, still valid token """
         while True:
-            await asyncio.sleep(3800)
-            self.creds = sac.from_json_keyfile_name("creds.json", self.scope)
-            self.client = gspread.authorize(self.creds)
-            self.client.login()
-            self.spreadsheet = self.client.open("AppMonitor")
+            expiry = self.creds.token_expiry
+            if expiry is None:
+                delay = 0
+            else:
+                delay = (expiry - datetime.datetime.utcnow()).total_seconds() - margin
+            await asyncio.sleep(max(delay, 0))
+            try:
+                await run_sheets(self.creds.refresh, httplib2.Http())
+                await run_sheets(self.client.login)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print("[!] Could not refresh Google credentials, retrying in a minute:", exc)
+                await asyncio.sleep(60)
+
+
+    async def reconcile(self):
+        """ Periodically reload the watch-list cache, in case the backing store was edited by hand """
+        await self.ready.wait()
+        while True:
+            # other workers write to the same database, so keep up with them more closely
+            await asyncio.sleep(getattr(config, "reconcile_interval", 60 if self.cluster else 60*30))
+            try:
+                await self.store.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print("[!] Could not reconcile watch-lists:", exc)
+                continue
+            await self.build_index()
+            if self.cluster:
+                # quiet windows set through another worker
+                self.quiet.load()
 
 
     @commands.cooldown(1, 5, type=commands.BucketType.user)
@@ -141,21 +632,16 @@ class Service(commands.Cog):
         aliases=["watchlist", "wl"],
         )
     async def watch(self, ctx, *sort):
-        first = True
-        back_emoji = "\U00002b05"
-        forward_emoji = "\U000027a1"
-        close_emoji = "\U0001f6ab"
-        page = 0
         reverse = False
-        outdated_count = 0
+        outdated_only = False
         id = str(ctx.message.author.id)
-        if not id in [worksheet.title for worksheet in self.spreadsheet.worksheets()]:
+        if not await self.store.has_user(id):
             await self.add_user(id)
         if ctx.message.author.name.endswith('s'):
             suffix = "'"
         else:
             suffix = "'s"
-        raw_data = self.spreadsheet.worksheet(id).get_all_records()
+        raw_data = await self.store.entries(id)
         if not raw_data:
             no_data_embed = await self.error_embed(description="You have not added any applications!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
             await ctx.channel.send(embed=no_data_embed)
@@ -178,36 +664,69 @@ class Service(commands.Cog):
             reverse = True
             outdated_only = False
         sorted_data = sorted(raw_data, key=lambda x: str(x[sorting]).lower(), reverse=reverse)
+        # lookups are memoized per page for the whole session, so paging back and forth is free
+        lookups = {}
+        def page_lookup(page):
+            if page not in lookups:
+                lookups[page] = self.bot.loop.create_task(self.lookup_many([(app["bundle_id"], app["country"]) for app in data[page]]))
+            return lookups[page]
+        def outdated(app, latest):
+            info = latest[(app["bundle_id"], app["country"])]
+            return not (info and str(app["version"]) == info['version'])
+        if outdated_only:
+            # filter the whole list first, so pages aren't left half-empty
+            latest = await self.lookup_many([(app["bundle_id"], app["country"]) for app in sorted_data])
+            sorted_data = [app for app in sorted_data if outdated(app, latest)]
+            if not sorted_data:
+                embed = await self.error_embed(description="You have no outdated applications!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
+                await ctx.channel.send(embed=embed)
+                return
         data = [sorted_data[x:x+10] for x in range(0, len(sorted_data), 10)]
+        try:
+            await self.watch_session(ctx, suffix, data, page_lookup, outdated)
+        finally:
+            for task in lookups.values():
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+
+    async def watch_session(self, ctx, suffix, data, page_lookup, outdated):
+        """ Render watch-list pages and handle the pagination reactions """
+        back_emoji = "\U00002b05"
+        forward_emoji = "\U000027a1"
+        close_emoji = "\U0001f6ab"
+        page = 0
+        msg = None
         while True:
-            fetching_embed = discord.Embed(color=0xe67e22, description="Fetching data...")
-            fetching_embed.set_author(name=ctx.message.author.name, icon_url=ctx.message.author.avatar_url)
-            if first:
-                msg = await ctx.channel.send(embed=fetching_embed)
-                first = False
-            else:
-                await msg.edit(embed=fetching_embed)
+            lookup = page_lookup(page)
+            if not lookup.done():
+                fetching_embed = discord.Embed(color=0xe67e22, description="Fetching data...")
+                fetching_embed.set_author(name=ctx.message.author.name, icon_url=ctx.message.author.avatar_url)
+                if msg is None:
+                    msg = await ctx.channel.send(embed=fetching_embed)
+                else:
+                    await msg.edit(embed=fetching_embed)
+            latest = await lookup
+            if page + 1 < len(data):
+                # prefetch while the user reads this page
+                page_lookup(page + 1)
             emoji_options = []
             if page > 0 :
                 emoji_options.append(back_emoji)
             embed = discord.Embed(color=0x2ecc71)
             embed.set_author(name="{}{} Watch-List ({}/{})".format(ctx.message.author.name, suffix, page+1, len(data)), icon_url=ctx.message.author.avatar_url)
             for app in data[page]:
-                latest_version = await self.fetch_version(app["bundle_id"], app["country"])
-                if str(app["version"]) == latest_version:
-                    if outdated_only:
-                        continue
+                if not outdated(app, latest):
                     embed.add_field(name=app['name'], value="[{}]({})  |  v{}  |  \u2705".format(app["bundle_id"], app["url"], app['version']), inline=False)
-                    # await ctx.channel.send(f"[{index}] " + app['name'] + " | " + app['version'])
                 else:
                     embed.add_field(name=app['name'], value="[{}]({})  |  v{}  |  \u2B06".format(app["bundle_id"], app["url"], app['version']), inline=False)
                     embed.color=0xe67e22
-                    outdated_count+=1
-            if outdated_only and outdated_count == 0:
-                embed = await self.error_embed(description="You have no outdated applications!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
+            if msg is None:
+                msg = await ctx.channel.send(embed=embed)
+            else:
                 await msg.edit(embed=embed)
-                return
-            await msg.edit(embed=embed)
             if 0 <= page < len(data)-1:
                 emoji_options.append(forward_emoji)
             emoji_options.append(close_emoji)
@@ -245,74 +764,71 @@ class Service(commands.Cog):
 
     @commands.command(
         name="Add",
-        description="Adds an application to your watch-list",
-        usage=".add <bundle identifier> *<country>",
+        description="Adds applications to your watch-list, or imports them from an attached text file",
+        usage=".add <bundle identifier> *<bundle identifier> … *<country>",
         aliases=["a"],
         )
     async def add(self, ctx, *bundle_ids):
-        if len(bundle_ids) == 0 or len(bundle_ids) > 11:
+        attachments = ctx.message.attachments
+        if (len(bundle_ids) == 0 and not attachments) or len(bundle_ids) > 11:
             return
         id = str(ctx.message.author.id)
-        if not id in [worksheet.title for worksheet in self.spreadsheet.worksheets()]:
+        if not await self.store.has_user(id):
             await self.add_user(id)
         if ctx.message.author.name.endswith('s'):
             suffix = "'"
         else:
             suffix = "'s"
-        if len(bundle_ids) > 1:
-            valid_country = False
-            for country_list in self.spreadsheet.worksheet("countries").get_all_records():
-                if bundle_ids[-1].lower() == country_list["country"]:
-                    country = country_list["code"].lower()
-                    valid_country = True
-                    break
-                elif bundle_ids[-1].lower() == country_list["country"]:
-                    country = country_list["code"].lower()
-                    valid_country = True
-                    break
-            if not valid_country:
-                country = "us"
+        bundle_ids = list(bundle_ids)
+        country = None
+        if len(bundle_ids) > 1 or (bundle_ids and attachments):
+            country = await self.resolve_country(bundle_ids[-1])
+            if country is not None:
+                bundle_ids.pop()
+        country = country or "us"
+        for attachment in attachments:
+            # one bundle identifier per line, or separated by whitespace or commas
+            bundle_ids.extend((await attachment.read()).decode("utf-8", "ignore").replace(",", " ").split())
+        if not bundle_ids:
+            return
+        results = await self.add_entries(id, bundle_ids, country)
+        added = [info for bundle_id, status, info in results if status == "added"]
+        skipped = {}
+        for bundle_id, status, info in results:
+            if status != "added":
+                skipped.setdefault(status, []).append(bundle_id)
+        if len(results) == 1 and not added:
+            description = {
+                "duplicate": "You've already added that application!",
+                "limit": "You've exceeded the maximum amount of applications!",
+                "not_found": "Application not found!",
+                }[results[0][1]]
+            embed = await self.error_embed(description=description, author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
+        elif not added:
+            embed = await self.error_embed(description=self.skipped_summary(skipped), author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
         else:
-            country = "us"
-        if len(bundle_ids) == 1:
-            added = await self.add_entry(ctx, str(ctx.message.author.id), bundle_ids[0], country)
-            if added != False:
+            if len(added) == 1:
                 embed = discord.Embed(color=0x2ecc71)
-                embed.set_author(name=added['results'][0]['trackName'], url=added['results'][0]['trackViewUrl'], icon_url=added['results'][0]['artworkUrl512'])
-                embed.set_footer(text="Added to {}{} watch-list.".format(ctx.message.author.name, suffix))
-            elif added == None:
-                embed = await self.error_embed(description="Application not found!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
+                embed.set_author(name=added[0]['trackName'], url=added[0]['trackViewUrl'], icon_url=added[0]['artworkUrl512'])
             else:
-                return
-        else:
-            added_applications = []
-            if valid_country:
-                for bundle_id in bundle_ids[0:-1]:
-                    added = await self.add_entry(ctx, str(ctx.message.author.id), bundle_id, country)
-                    if added != False:
-                        added_applications.append(added['results'][0]['trackName'])
-                    else:
-                        return
-            else:
-                for bundle_id in bundle_ids:
-                    added = await self.add_entry(ctx, str(ctx.message.author.id), bundle_id, country)
-                    if added:
-                        added_applications.append(added['results'][0]['trackName'])
-                    else:
-                        return
-            if added_applications:
-                if len(added_applications) == 1:
-                    embed = discord.Embed(color=0x2ecc71)
-                    embed.set_author(name=added['results'][0]['trackName'], url=added['results'][0]['trackViewUrl'], icon_url=added['results'][0]['artworkUrl512'])
-                elif len(added_applications) > 1:
-                    embed = discord.Embed(color=0x2ecc71, description=", ".join(added_applications))
-                    embed.set_author(name="Applications Added")
-                embed.set_footer(text="Added to {}{} watch-list.".format(ctx.message.author.name, suffix))
-            else:
-                embed = await self.error_embed(description="Application not found!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
+                embed = discord.Embed(color=0x2ecc71, description=", ".join(info['trackName'] for info in added))
+                embed.set_author(name="Applications Added")
+            if skipped:
+                embed.add_field(name="Skipped", value=self.skipped_summary(skipped), inline=False)
+            embed.set_footer(text="Added to {}{} watch-list.".format(ctx.message.author.name, suffix))
         await ctx.channel.send(embed=embed)
 
 
+    def skipped_summary(self, skipped):
+        """ Describe the bundle IDs add_entries() didn't add, by reason """
+        reasons = [
+            ("duplicate", "Already added"),
+            ("not_found", "Not found"),
+            ("limit", "Over the {} application limit".format(MAX_ENTRIES)),
+            ]
+        return "\n".join("{}: {}".format(label, ", ".join(skipped[status])) for status, label in reasons if status in skipped)[:1024]
+
+
     @commands.command(
         name="Update",
         description="Updates an application's version in your watch-list to the latest version",
@@ -321,7 +837,7 @@ class Service(commands.Cog):
         )
     async def update(self, ctx, bundle_id):
         id = str(ctx.message.author.id)
-        if not id in [worksheet.title for worksheet in self.spreadsheet.worksheets()]:
+        if not await self.store.has_user(id):
             await self.add_user(id)
         if ctx.message.author.name.endswith('s'):
             suffix = "'"
@@ -330,7 +846,7 @@ class Service(commands.Cog):
         updated = await self.update_entry(id, bundle_id)
         if updated:
             embed = discord.Embed(color=0x2ecc71)
-            embed.set_author(name=updated[1], url=updated[5], icon_url=updated[4])
+            embed.set_author(name=updated["name"], url=updated["url"], icon_url=updated["icon"])
             embed.set_footer(text="Updated {}{} watch-list.".format(ctx.message.author.name, suffix))
         else:
             embed = await self.error_embed(description="Application not found!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
@@ -345,7 +861,7 @@ class Service(commands.Cog):
         )
     async def remove(self, ctx, bundle_id):
         id = str(ctx.message.author.id)
-        if not id in [worksheet.title for worksheet in self.spreadsheet.worksheets()]:
+        if not await self.store.has_user(id):
             await self.add_user(id)
         if ctx.message.author.name.endswith('s'):
             suffix = "'"
@@ -353,12 +869,26 @@ class Service(commands.Cog):
             suffix = "'s"
         removed = await self.remove_entry(id, bundle_id)
         if removed:
-            embed = await self.error_embed(author=removed[1], author_url=removed[5], author_icon=removed[4], footer="Removed from {}{} watch-list.".format(ctx.message.author.name, suffix))
+            embed = await self.error_embed(author=removed["name"], author_url=removed["url"], author_icon=removed["icon"], footer="Removed from {}{} watch-list.".format(ctx.message.author.name, suffix))
         else:
             embed = await self.error_embed(description="Application not found!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url)
         await ctx.channel.send(embed=embed)
 
 
+    @commands.is_owner()
+    @commands.command(
+        name="RefreshCountries",
+        description="Reloads the countries table",
+        usage=".refreshcountries",
+        hidden=True,
+        )
+    async def refresh_countries(self, ctx):
+        await self.countries.refresh(self.store)
+        embed = discord.Embed(color=0x2ecc71, description="Loaded {} countries.".format(len(self.countries.codes)))
+        embed.set_author(name="Countries")
+        await ctx.channel.send(embed=embed)
+
+
     # @commands.command(
     #     name="countries",
     #     description="Lists the supported countries in the App Store",
@@ -377,58 +907,171 @@ class Service(commands.Cog):
         aliases=["s", "find"]
         )
     async def search(self, ctx, name, *country):
-        emoji_options = ["\u2705"]
         if not country:
             country = "us"
         else:
-            valid_country = False
-            for country_list in self.spreadsheet.worksheet("countries").get_all_records():
-                if country[0].lower() == country_list["country"]:
-                    country = country_list["code"].lower()
-                    valid_country = True
-                    break
-                elif country[0].lower() == country_list["country"]:
-                    country = country_list["code"].lower()
-                    valid_country = True
-                    break
-            if not valid_country:
-                country = "us"
-        url = "https://itunes.apple.com/search?term=" + name + "&entity=software&country=" + country
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                info = json.loads(await resp.read())
-        for app in info["results"]:
-            embed=discord.Embed(title=app["trackName"], url=app["trackViewUrl"], color=0x1C89F5)
-            embed.set_thumbnail(url=app["artworkUrl100"])
-            embed.add_field(name="Bundle ID", value=app["bundleId"], inline=True)
-            try:
-                embed.add_field(name="Price", value=app["formattedPrice"], inline=True)
-            except:
-                embed.add_field(name="Price", value="Unknown", inline=True)
-            try:
-                embed.add_field(name="Rating", value=f"{app['averageUserRating']}/5 of out {app['userRatingCount']} ratings", inline=True)
-            except:
-                embed.add_field(name="Rating", value="N/A", inline=True)
-            try:
-                embed.add_field(name="Update Date", value=app["currentVersionReleaseDate"], inline=True)
-            except:
-                embed.add_field(name="Update Date", value="N/A", inline=True)
-            embed.set_footer(text=f"v{app['version']} by {app['sellerName']}")
-            msg = await ctx.channel.send(embed=embed)
+            country = await self.resolve_country(country[0]) or "us"
+        results = await self.search_apps(name, country)
+        if not results:
+            await ctx.channel.send(embed=await self.error_embed(description="No applications found!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url))
+            return
+        await self.search_session(ctx, results, country)
+
+
+    def search_embed(self, app, page, pages):
+        embed=discord.Embed(title=app["trackName"], url=app["trackViewUrl"], color=0x1C89F5)
+        embed.set_thumbnail(url=app["artworkUrl100"])
+        embed.add_field(name="Bundle ID", value=app["bundleId"], inline=True)
+        embed.add_field(name="Price", value=app.get("formattedPrice", "Unknown"), inline=True)
+        if "averageUserRating" in app and "userRatingCount" in app:
+            embed.add_field(name="Rating", value=f"{app['averageUserRating']}/5 of out {app['userRatingCount']} ratings", inline=True)
+        else:
+            embed.add_field(name="Rating", value="N/A", inline=True)
+        embed.add_field(name="Update Date", value=app.get("currentVersionReleaseDate", "N/A"), inline=True)
+        embed.set_footer(text=f"v{app['version']} by {app['sellerName']}  |  {page+1}/{pages}")
+        return embed
+
+
+    async def search_session(self, ctx, results, country):
+        """ Page through search results with reactions, adding the shown one on \u2705 """
+        back_emoji = "\U00002b05"
+        forward_emoji = "\U000027a1"
+        add_emoji = "\u2705"
+        close_emoji = "\U0001f6ab"
+        page = 0
+        msg = None
+        while True:
+            app = results[page]
+            embed = self.search_embed(app, page, len(results))
+            if msg is None:
+                msg = await ctx.channel.send(embed=embed)
+            else:
+                await msg.edit(embed=embed)
+            emoji_options = []
+            if page > 0:
+                emoji_options.append(back_emoji)
+            emoji_options.append(add_emoji)
+            if page < len(results)-1:
+                emoji_options.append(forward_emoji)
+            emoji_options.append(close_emoji)
+            for emoji in emoji_options:
+                await msg.add_reaction(emoji)
             def check(reaction, user):
                 if str(reaction.emoji) not in emoji_options or user != ctx.message.author:
                     if user != ctx.bot.user:
                         self.bot.loop.create_task(msg.remove_reaction(str(reaction.emoji), user))
                 return user == ctx.message.author and str(reaction.emoji) in emoji_options and reaction.message.id == msg.id
-            await msg.add_reaction(emoji_options[0])
             try:
-                reaction = await ctx.bot.wait_for('reaction_add', timeout=30.0, check=check)
+                reaction = await ctx.bot.wait_for('reaction_add', timeout=50.0, check=check)
             except asyncio.TimeoutError:
-                await msg.remove_reaction(emoji_options[0], ctx.guild.me)
+                await msg.clear_reactions()
                 return
-            if str(reaction[0].emoji) == emoji_options[0]:
-                self.bot.loop.create_task(ctx.invoke(self.bot.get_command("add"), app["bundleId"]))
-            break
+            await msg.clear_reactions()
+            if reaction[0].emoji == forward_emoji:
+                page += 1
+            elif reaction[0].emoji == back_emoji:
+                page -= 1
+            elif reaction[0].emoji == add_emoji:
+                self.bot.loop.create_task(ctx.invoke(self.bot.get_command("add"), app["bundleId"], country))
+                return
+            elif reaction[0].emoji == close_emoji:
+                return
+
+
+    @commands.command(
+        name="Quiet",
+        description="Collects your update notifications into one DM at most every so many minutes, 0 to turn it off",
+        usage=".quiet *<minutes>",
+        aliases=["q"],
+        )
+    async def quiet(self, ctx, minutes=None):
+        id = str(ctx.message.author.id)
+        if minutes is not None:
+            try:
+                minutes = int(minutes)
+            except ValueError:
+                return
+            if not 0 <= minutes <= 60*24*7:
+                await ctx.channel.send(embed=await self.error_embed(description="Pick between 0 minutes and a week!", author=ctx.message.author.name, author_icon=ctx.message.author.avatar_url))
+                return
+            self.quiet.set(id, minutes)
+        minutes = self.quiet.get(id)
+        if minutes:
+            description = "Updates are collected into one message at most every {} minutes.".format(minutes)
+        else:
+            description = "Updates are sent after every check."
+        embed = discord.Embed(color=0x2ecc71, description=description)
+        embed.set_author(name="Quiet Window", icon_url=ctx.message.author.avatar_url)
+        await ctx.channel.send(embed=embed)
+
+
+    @commands.is_owner()
+    @commands.command(
+        name="Migrate",
+        description="Imports the AppMonitor spreadsheet into the local database",
+        usage=".migrate",
+        hidden=True,
+        )
+    async def migrate(self, ctx):
+        if isinstance(self.store.backend, SQLiteStore):
+            users, entries = await migrate_store(SheetStore(await self.open_spreadsheet()), self.store.backend)
+            await self.store.reconcile()
+            await self.build_index()
+            # start() loaded the countries table before there was anything in it
+            await self.countries.refresh(self.store)
+        else:
+            target = SQLiteStore(getattr(config, "database", "appmonitor.db"))
+            users, entries = await migrate_store(SheetStore(await self.open_spreadsheet()), target)
+            await target.close()
+        embed = discord.Embed(color=0x2ecc71, description="Imported {} watch-lists with {} applications.".format(users, entries))
+        embed.set_author(name="Migration Complete")
+        await ctx.channel.send(embed=embed)
+
+
+    @commands.is_owner()
+    @commands.command(
+        name="Stats",
+        description="Runtime statistics: checks, API calls, cache and queues",
+        usage=".stats",
+        hidden=True,
+        )
+    async def stats(self, ctx):
+        cache = version_cache.stats()
+        worst, p99 = self.lag_monitor.current()
+        sheets = sorted(sheets_calls.values.items(), key=lambda item: -item[1])
+        appstore_errors = sum(value for (endpoint, status), value in requests_total.values.items() if not status.startswith("2"))
+        embed = discord.Embed(color=0x95a5a6)
+        embed.set_author(name="Stats")
+        embed.add_field(name="Checks", value="{} ok, {} not found, {} failed\n{:.0f}ms per batch, {:.1f}s per sweep".format(checks_total.get("ok"), checks_total.get("not_found"), checks_total.get("failed"), check_seconds.mean() * 1000, sweep_seconds.mean()), inline=True)
+        embed.add_field(name="Polling", value="{} apps scheduled\n{} watched".format(len(self.scheduler), len(self.index)), inline=True)
+        embed.add_field(name="App Store", value="{} requests, {} errors\n{:.0f}ms per lookup".format(requests_total.total(), appstore_errors, request_seconds.mean("lookup") * 1000), inline=True)
+        embed.add_field(name="Version Cache", value="{:.0%} hits of {}\n{} entries".format(cache["hit_ratio"], cache["hits"] + cache["coalesced"] + cache["misses"], cache["size"]), inline=True)
+        tokens, lanes = self.appstore_limiter.state()
+        embed.add_field(name="Rate Limiter", value="{:.1f} tokens\n".format(tokens) + "\n".join("{} {:.2f}/s, {} waiting, {} throttled".format(lane, stats["rate"], stats["waiting"], stats["throttled"]) for lane, stats in lanes.items()), inline=True)
+        searches = search_cache.stats()
+        embed.add_field(name="Search Cache", value="{:.0%} hits of {}\n{} entries".format(searches["hit_ratio"], searches["hits"] + searches["coalesced"] + searches["misses"], searches["size"]), inline=True)
+        embed.add_field(name="Sheets", value="{} calls\n{}".format(sheets_calls.total(), ", ".join("{} {}".format(method, count) for (method,), count in sheets[:4]) or "none"), inline=True)
+        embed.add_field(name="DMs", value="{} sent, {} failed\n{} updates, {} waiting".format(dms_total.get("sent"), dms_total.get("failed") + dms_total.get("forbidden"), updates_total.get(), len(self.digests)), inline=True)
+        embed.add_field(name="Queues", value="check {}  |  change {}  |  dm {}".format(self.check_queue.qsize(), self.change_queue.qsize(), self.dm_queue.qsize()), inline=False)
+        embed.add_field(name="Event Loop", value="worst {:.0f}ms  |  p99 {:.0f}ms this minute".format(worst * 1000, p99 * 1000), inline=False)
+        await ctx.channel.send(embed=embed)
+
+
+    @commands.is_owner()
+    @commands.command(
+        name="Lag",
+        description="Worst and p99 event loop stalls per minute",
+        usage=".lag",
+        hidden=True,
+        )
+    async def lag(self, ctx):
+        worst, p99 = self.lag_monitor.current()
+        lines = ["now  |  worst {:.0f}ms  |  p99 {:.0f}ms".format(worst * 1000, p99 * 1000)]
+        for window_start, worst, p99, samples in reversed(list(self.lag_monitor.history)[-10:]):
+            lines.append("{}  |  worst {:.0f}ms  |  p99 {:.0f}ms".format(time.strftime("%H:%M", time.localtime(window_start)), worst * 1000, p99 * 1000))
+        embed = discord.Embed(color=0x95a5a6, description="\n".join(lines))
+        embed.set_author(name="Event Loop Lag")
+        await ctx.channel.send(embed=embed)
 
 
     @commands.command(
@@ -449,5 +1092,11 @@ class Service(commands.Cog):
 def setup(bot):
     cog=Service(bot)
     bot.add_cog(cog)
-    bot.loop.create_task(cog.refresh_token())
-    bot.loop.create_task(cog.notify())
+    cog.tasks.append(bot.loop.create_task(cog.start()))
+    cog.tasks.append(bot.loop.create_task(cog.notify()))
+    cog.tasks.append(bot.loop.create_task(cog.reconcile()))
+    cog.tasks.append(bot.loop.create_task(cog.lag_monitor.run()))
+    if cog.cluster:
+        cog.tasks.append(bot.loop.create_task(cog.cluster.run()))
+    if cog.metrics_server.port:
+        cog.tasks.append(bot.loop.create_task(cog.start_metrics_server()))
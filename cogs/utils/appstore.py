@@ -0,0 +1,262 @@
+import asyncio
+import email.utils
+import json
+import random
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from .metrics import metrics
+
+
+requests_total = metrics.counter("appmonitor_appstore_requests_total", "App Store HTTP requests by endpoint and status", ["endpoint", "status"])
+request_seconds = metrics.histogram("appmonitor_appstore_request_seconds", "App Store HTTP request latency", ["endpoint"])
+
+
+# bundle IDs per lookup request, keeps the URL well inside the endpoint's limits
+LOOKUP_CHUNK_SIZE = 100
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+class AppStoreError(Exception):
+    """ The App Store could not be reached, or kept refusing the request """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def retry_after(resp):
+    """ Seconds the server asked us to wait, if it sent a Retry-After header """
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_to_datetime(value) if email.utils.parsedate(value) else None
+    if date is None:
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class AppStoreClient:
+    """ Long-lived, pooled client for the iTunes lookup and search endpoints """
+    def __init__(self, base_url="https://itunes.apple.com", limit=32, limit_per_host=8, timeout=10, retries=4, backoff=0.5, max_backoff=30, limiter=None):
+        self.base_url = base_url
+        self.limiter = limiter
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def delay(self, attempt, wait=None):
+        """ Full-jitter exponential backoff, never shorter than what the server asked for
+        but never longer than max_backoff """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if wait is not None:
+            delay = min(self.max_backoff, max(delay, wait))
+        return delay
+
+    async def get_json(self, path, params, lane="interactive"):
+        """ GET a JSON document, retrying connection errors, 429s and 5xx responses.
+        Every attempt first waits for the limiter in `lane` """
+        error = None
+        endpoint = path.rsplit("/", 1)[-1]
+        for attempt in range(self.retries + 1):
+            wait = None
+            if self.limiter is not None:
+                await self.limiter.acquire(lane)
+            try:
+                with request_seconds.time(endpoint):
+                    async with self.session.get(self.base_url + path, params=params) as resp:
+                        requests_total.inc(endpoint, str(resp.status))
+                        if resp.status == 429 and self.limiter is not None:
+                            self.limiter.throttled(lane)
+                        if resp.status == 429 or resp.status >= 500:
+                            wait = retry_after(resp)
+                            error = AppStoreError("App Store responded with HTTP {}".format(resp.status), resp.status)
+                        elif resp.status >= 400:
+                            raise AppStoreError("App Store responded with HTTP {}".format(resp.status), resp.status)
+                        else:
+                            if self.limiter is not None:
+                                self.limiter.succeeded(lane)
+                            # the store serves JSON as text/javascript
+                            return json.loads(await resp.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+                requests_total.inc(endpoint, "error")
+                error = AppStoreError("App Store request failed: {!r}".format(exc))
+            if wait is not None and wait > self.max_backoff:
+                # not worth holding a command or a check worker for, give up now
+                raise error
+            if attempt < self.retries:
+                await asyncio.sleep(self.delay(attempt, wait))
+        raise error
+
+    async def lookup(self, bundle_ids, country, lane="interactive"):
+        """ Look up up to LOOKUP_CHUNK_SIZE bundle IDs in one request, returns {bundle_id: info} """
+        info = await self.get_json("/" + country + "/lookup", {"bundleId": ",".join(bundle_ids)}, lane)
+        found = {app['bundleId'].lower(): app for app in info['results'] if 'bundleId' in app}
+        return {bundle_id: found.get(bundle_id.lower()) for bundle_id in bundle_ids}
+
+    async def search(self, term, country, lane="interactive"):
+        return await self.get_json("/search", {"term": term, "entity": "software", "country": country}, lane)
+
+
+class VersionCache:
+    """ Process-wide TTL/LRU cache of App Store lookups keyed by (bundle_id, country) """
+    def __init__(self, ttl=60, maxsize=4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    @staticmethod
+    def key(bundle_id, country):
+        return (bundle_id.lower(), country.lower())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires, result = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, result
+
+    def put(self, bundle_id, country, result, ttl=None):
+        """ Store a lookup result (None for "not found") for `ttl` seconds, by default the
+        cache's, evicting the least recently used """
+        key = self.key(bundle_id, country)
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def configure(self, ttl=None, maxsize=None):
+        """ Change the TTL and size, e.g. from the bot's config once it's loaded """
+        if ttl is not None:
+            self.ttl = ttl
+        if maxsize is not None:
+            self.maxsize = maxsize
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get(self, bundle_id, country, fetch):
+        """ Return the cached result for a key, awaiting fetch() on a miss.
+        Concurrent misses for the same key share a single fetch. """
+        async def fetch_one(pairs):
+            return {pairs[0]: await fetch()}
+        return (await self.get_many([(bundle_id, country)], fetch_one))[(bundle_id, country)]
+
+    async def get_many(self, pairs, fetch_many):
+        """ Return {(bundle_id, country): result} for every pair. fetch_many() is awaited once
+        with the pairs that are neither cached nor already in flight, and must return a dict
+        keyed by those pairs. """
+        pairs = list(pairs)
+        wanted = OrderedDict()
+        for pair in pairs:
+            wanted.setdefault(self.key(*pair), pair)
+        results = {}
+        waiting = {}
+        missing = OrderedDict()
+        for key, pair in wanted.items():
+            found, result = self._get_fresh(key)
+            if found:
+                self.hits += 1
+                results[key] = result
+            elif key in self._pending:
+                self.coalesced += 1
+                waiting[key] = self._pending[key]
+            else:
+                self.misses += 1
+                missing[key] = pair
+        if missing:
+            loop = asyncio.get_event_loop()
+            futures = {key: loop.create_future() for key in missing}
+            self._pending.update(futures)
+            # in its own task, so cancelling this caller only stops it waiting, not the others
+            asyncio.ensure_future(self._fetch(missing, futures, fetch_many))
+            waiting.update(futures)
+        for key, future in waiting.items():
+            results[key] = await asyncio.shield(future)
+        return {pair: results[self.key(*pair)] for pair in pairs}
+
+    async def _fetch(self, missing, futures, fetch_many):
+        """ Fetch the missing keys for get_many() and resolve everyone's futures """
+        try:
+            fetched = await fetch_many(list(missing.values()))
+        except asyncio.CancelledError:
+            # nobody else cancels this task, the loop is going away
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as exc:
+            for future in futures.values():
+                future.set_exception(exc)
+                future.exception()  # waiters re-raise it; don't warn when there are none
+            return
+        finally:
+            for key in missing:
+                del self._pending[key]
+        for key, pair in missing.items():
+            result = fetched.get(pair)
+            self.put(*pair, result)
+            futures[key].set_result(result)
+
+    def stats(self):
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+
+version_cache = VersionCache()
+
+
+class SearchCache(VersionCache):
+    """ TTL/LRU cache of App Store search responses keyed by (term, country) """
+    def __init__(self, ttl=300, maxsize=256):
+        super().__init__(ttl, maxsize)
+
+    @staticmethod
+    def key(term, country):
+        return (" ".join(term.lower().split()), country.lower())
+
+
+search_cache = SearchCache()
@@ -0,0 +1,103 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import time
+
+
+def stable_hash(value):
+    """ A hash that is the same in every process, unlike hash() """
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """ Consistent hash ring: each worker owns the keys between its points and
+    the previous ones, so a worker joining or leaving only moves its own share """
+    def __init__(self, workers=(), replicas=100):
+        self.replicas = replicas
+        self.workers = sorted(workers)
+        self._points = sorted((stable_hash("{}#{}".format(worker, i)), worker) for worker in self.workers for i in range(replicas))
+        self._hashes = [point for point, worker in self._points]
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._hashes, stable_hash(key)) % len(self._points)
+        return self._points[i][1]
+
+
+class Cluster:
+    """ Polling ownership across bot processes.
+
+    Every worker writes a heartbeat file into a shared directory; workers whose
+    heartbeat is older than `timeout` are considered dead. (bundle_id, country)
+    keys are partitioned over the live workers with a HashRing, rebuilt
+    whenever the live set changes, so a dead worker's share is taken over by
+    the others within `timeout` seconds. """
+    def __init__(self, worker_id, directory, interval=10, timeout=30):
+        self.worker_id = worker_id
+        self.directory = directory
+        self.interval = interval
+        self.timeout = timeout
+        self.ring = HashRing([worker_id])
+        # published with every heartbeat, e.g. where this worker serves metrics
+        self.info = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def workers(self):
+        return self.ring.workers
+
+    def _path(self, worker_id):
+        return os.path.join(self.directory, worker_id + ".json")
+
+    def owns(self, key):
+        return self.ring.owner("/".join(key)) == self.worker_id
+
+    def heartbeat(self, now=None):
+        now = time.time() if now is None else now
+        tmp = self._path(self.worker_id) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(dict(self.info, worker=self.worker_id, time=now, pid=os.getpid()), f)
+        os.replace(tmp, self._path(self.worker_id))
+
+    def live_workers(self, now=None):
+        now = time.time() if now is None else now
+        workers = {self.worker_id}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    beat = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if now - beat.get("time", 0) <= self.timeout:
+                workers.add(beat["worker"])
+        return workers
+
+    def rebalance(self, now=None):
+        """ Rebuild the ring from the live workers, returns True if membership changed """
+        workers = self.live_workers(now)
+        if sorted(workers) == self.ring.workers:
+            return False
+        self.ring = HashRing(workers, self.ring.replicas)
+        return True
+
+    async def run(self):
+        while True:
+            try:
+                self.heartbeat()
+                if self.rebalance():
+                    print("[*] Polling shared between", len(self.workers), "workers:", ", ".join(self.workers))
+            except OSError as exc:
+                print("[!] Cluster heartbeat failed:", exc)
+            await asyncio.sleep(self.interval)
+
+    def leave(self):
+        """ Drop our heartbeat so the others take over right away """
+        try:
+            os.remove(self._path(self.worker_id))
+        except OSError:
+            pass
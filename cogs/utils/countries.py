@@ -0,0 +1,73 @@
+import bisect
+
+
+# common names people type that aren't in the countries sheet
+ALIASES = {
+    "usa": "us",
+    "america": "us",
+    "united states of america": "us",
+    "uk": "gb",
+    "britain": "gb",
+    "great britain": "gb",
+    "england": "gb",
+    "holland": "nl",
+    "korea": "kr",
+    "south korea": "kr",
+    "uae": "ae",
+    "emirates": "ae",
+    }
+
+
+class CountryResolver:
+    """ Resolves App Store country names, ISO codes and aliases to lowercase store codes.
+
+    Matching is case-insensitive; names and aliases can also be given by an
+    unambiguous prefix of at least min_prefix characters. """
+    def __init__(self, aliases=ALIASES, min_prefix=3):
+        self.aliases = aliases
+        self.min_prefix = min_prefix
+        self.codes = set()
+        self.names = {}
+        self._sorted_names = []
+        self.loaded = False
+
+    def load(self, rows):
+        """ Build the lookup tables from countries sheet rows ({"country", "code", optional "aliases"}) """
+        codes = set()
+        names = {}
+        for row in rows:
+            code = str(row["code"]).strip().lower()
+            codes.add(code)
+            names[str(row["country"]).strip().lower()] = code
+            for alias in str(row.get("aliases") or "").split(","):
+                if alias.strip():
+                    names[alias.strip().lower()] = code
+        for alias, code in self.aliases.items():
+            if code in codes:
+                names.setdefault(alias, code)
+        self.codes = codes
+        self.names = names
+        self._sorted_names = sorted(names)
+        self.loaded = True
+
+    async def refresh(self, store):
+        self.load(await store.countries())
+
+    def resolve(self, text):
+        """ Store code for text, or None if it isn't a (unique) country """
+        text = text.strip().lower()
+        if text in self.codes:
+            return text
+        if text in self.names:
+            return self.names[text]
+        if len(text) < self.min_prefix:
+            return None
+        start = bisect.bisect_left(self._sorted_names, text)
+        matches = set()
+        for name in self._sorted_names[start:]:
+            if not name.startswith(text):
+                break
+            matches.add(self.names[name])
+        if len(matches) == 1:
+            return matches.pop()
+        return None
@@ -0,0 +1,85 @@
+import json
+import os
+import time
+
+
+class QuietWindows:
+    """ Per-user minimum minutes between update digests, saved to a JSON file.
+
+    When digests were last sent is only known to this process, so in a cluster
+    each worker keeps its own window for the apps it polls. """
+    def __init__(self, path):
+        self.path = path
+        self.minutes = {}
+        self.last_sent = {}
+
+    def load(self):
+        """ Read the saved windows, keeping the current ones if the file is missing or corrupt """
+        try:
+            with open(self.path) as f:
+                minutes = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.minutes = {str(user_id): int(value) for user_id, value in minutes.items()}
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.minutes, f)
+        os.replace(tmp, self.path)
+
+    def get(self, user_id):
+        return self.minutes.get(user_id, 0)
+
+    def set(self, user_id, minutes):
+        # workers in a cluster share the file, so change what's on disk rather than our copy of it
+        self.load()
+        if minutes:
+            self.minutes[user_id] = minutes
+        else:
+            self.minutes.pop(user_id, None)
+        self.save()
+
+    def due(self, user_id, now=None):
+        """ Whether a digest for user_id may go out now """
+        now = time.time() if now is None else now
+        return now - self.last_sent.get(user_id, 0) >= self.get(user_id) * 60
+
+    def sent(self, user_id, now=None):
+        self.last_sent[user_id] = time.time() if now is None else now
+
+
+class Digests:
+    """ Updates collected per user, {user_id: {key: (application, info)}}, until their digest goes out """
+    def __init__(self):
+        self.pending = {}
+
+    def __len__(self):
+        return sum(len(updates) for updates in self.pending.values())
+
+    def add(self, user_id, key, application, info):
+        self.pending.setdefault(user_id, {})[key] = (application, info)
+
+    def refresh(self, user_id, key, info):
+        """ Replace the latest version of an update that's still waiting, if there is one """
+        updates = self.pending.get(user_id)
+        if updates and key in updates:
+            updates[key] = (updates[key][0], info)
+
+    def discard(self, user_id, key):
+        """ Drop a waiting update, e.g. once the user has acknowledged or removed the app """
+        updates = self.pending.get(user_id)
+        if updates:
+            updates.pop(key, None)
+            if not updates:
+                del self.pending[user_id]
+
+    def pop_due(self, quiet, now=None):
+        """ [(user_id, [(key, application, info)])] for every user whose quiet window has passed """
+        now = time.time() if now is None else now
+        due = []
+        for user_id in [user_id for user_id in self.pending if quiet.due(user_id, now)]:
+            updates = self.pending.pop(user_id)
+            quiet.sent(user_id, now)
+            due.append((user_id, [(key, application, info) for key, (application, info) in updates.items()]))
+        return due
@@ -0,0 +1,51 @@
+class SubscriberIndex:
+    """ Inverted watch-list index: (bundle_id, country) -> {user_id: entry}
+
+    Entries are the user's watch-list rows (bundle_id, name, version, country,
+    icon, url, notified), so the sweep can poll every distinct app once and
+    compare the result against each subscriber's acknowledged version. """
+    def __init__(self):
+        self._apps = {}
+
+    @staticmethod
+    def key(bundle_id, country):
+        return (str(bundle_id).lower(), str(country).lower())
+
+    def __len__(self):
+        return len(self._apps)
+
+    def __contains__(self, key):
+        return key in self._apps
+
+    def items(self):
+        return list(self._apps.items())
+
+    def subscribers(self, bundle_id, country):
+        return self._apps.get(self.key(bundle_id, country), {})
+
+    def add(self, user_id, entry):
+        """ Add or replace a user's entry """
+        entry = dict(entry, version=str(entry["version"]), notified=int(entry["notified"] or 0))
+        self._apps.setdefault(self.key(entry["bundle_id"], entry["country"]), {})[str(user_id)] = entry
+
+    update = add
+
+    def remove(self, user_id, bundle_id, country):
+        key = self.key(bundle_id, country)
+        subscribers = self._apps.get(key)
+        if subscribers is None:
+            return
+        subscribers.pop(str(user_id), None)
+        if not subscribers:
+            del self._apps[key]
+
+    def rebuild(self, watch_lists):
+        """ Replace the index from an iterable of (user_id, entries) """
+        self._apps = {}
+        for user_id, entries in watch_lists:
+            for entry in entries:
+                self.add(user_id, entry)
+
+    def pending(self):
+        """ Keys with at least one subscriber that hasn't been notified yet """
+        return [key for key, subscribers in self._apps.items() if any(entry["notified"] == 0 for entry in subscribers.values())]
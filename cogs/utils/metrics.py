@@ -0,0 +1,176 @@
+import bisect
+import time
+
+from aiohttp import web
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs) + "}"
+
+    def samples(self):
+        """ (suffix, label values, extra labels, value) tuples """
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for suffix, values, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, self._label_text(values, extra), value))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def total(self):
+        return sum(self.values.values())
+
+    def samples(self):
+        return [("", labels, (), value) for labels, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """ Read from a callback at collection time, which returns a number or {label values: number} """
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            return [("", labels, (), v) for labels, v in sorted(value.items())]
+        return [("", (), (), value)]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += 1
+        series[2] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def count(self, *labels):
+        series = self.values.get(labels)
+        return series[1] if series else 0
+
+    def mean(self, *labels):
+        series = self.values.get(labels)
+        return series[2] / series[1] if series and series[1] else 0.0
+
+    def samples(self):
+        samples = []
+        for labels, (counts, count, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", labels, (("le", bound),), cumulative))
+            samples.append(("_count", labels, (), count))
+            samples.append(("_sum", labels, (), total))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        # reloading the cog re-registers its gauges, the newest wins
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.metrics.get(name) or self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.BUCKETS):
+        return self.metrics.get(name) or self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self._register(Gauge(name, help, fn, labels))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+class MetricsServer:
+    """ Serves the registry in Prometheus' text format at /metrics """
+    def __init__(self, registry, host="127.0.0.1", port=9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request):
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, attempts=1):
+        """ Listen on port, or the first free one of the `attempts` ports from it; self.port is the one taken """
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        for port in range(self.port, self.port + attempts):
+            try:
+                await web.TCPSite(self.runner, self.host, port).start()
+            except OSError:
+                if port == self.port + attempts - 1:
+                    await self.stop()
+                    raise
+                continue
+            self.port = port
+            return
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+metrics = Registry()
@@ -0,0 +1,49 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+
+def percentile(samples, p):
+    """ Nearest-rank percentile of a list of numbers """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class LoopLagMonitor:
+    """ Measures event-loop stalls by how late a short sleep wakes up.
+
+    Every window seconds the worst and p99 lag are appended to history, and
+    windows whose worst stall exceeds warn_after seconds are printed. """
+    def __init__(self, interval=0.1, window=60, history=60, warn_after=0.5):
+        self.interval = interval
+        self.window = window
+        self.warn_after = warn_after
+        self.history = deque(maxlen=history)
+        self._samples = []
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        window_start = time.time()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self._samples.append(max(0.0, loop.time() - start - self.interval))
+            if time.time() - window_start >= self.window:
+                self.roll(window_start)
+                window_start = time.time()
+
+    def roll(self, window_start):
+        """ Close the current window """
+        worst = max(self._samples, default=0.0)
+        p99 = percentile(self._samples, 99)
+        self.history.append((window_start, worst, p99, len(self._samples)))
+        self._samples = []
+        if worst > self.warn_after:
+            print("[!] Event loop stalled for up to {:.0f}ms in the last minute (p99 {:.0f}ms)".format(worst * 1000, p99 * 1000))
+
+    def current(self):
+        """ (worst, p99) of the window in progress """
+        return max(self._samples, default=0.0), percentile(self._samples, 99)
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """ `rate` tokens per second, bursting up to `capacity` """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        """ Change the refill rate, keeping the tokens earned at the old one """
+        self._refill()
+        self.rate = rate
+
+    def try_acquire(self, tokens=1):
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """ Seconds until `tokens` would be available """
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+
+class KeyedTokenBucket:
+    """ A TokenBucket per key (e.g. per Discord route) behind a shared global one """
+    def __init__(self, rate, capacity=None, global_rate=None, global_capacity=None, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.global_bucket = TokenBucket(global_rate, global_capacity) if global_rate else None
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                # drop buckets that have refilled, they carry no state
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket.delay(bucket.capacity) > 0}
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket
+
+    async def acquire(self, key):
+        await self.bucket(key).acquire()
+        if self.global_bucket is not None:
+            await self.global_bucket.acquire()
+
+
+class PriorityLimiter:
+    """ One shared TokenBucket handed out in lane order: a waiter in an earlier lane always
+    goes before any in a later one. Lanes listed in `adaptive` are also held to their own
+    rate, halved whenever they're throttled and raised by `increase` per success (AIMD). """
+    def __init__(self, rate, capacity=None, lanes=("interactive", "background"), adaptive=("background",), min_rate=0.1, increase=0.05):
+        self.bucket = TokenBucket(rate, capacity)
+        self.lanes = lanes
+        self.waiting = {lane: deque() for lane in lanes}
+        self.adaptive = {lane: TokenBucket(rate, capacity) for lane in adaptive}
+        self.min_rate = min_rate
+        self.increase = increase
+        self.throttled_total = {lane: 0 for lane in lanes}
+        self._timer = None
+
+    async def acquire(self, lane):
+        if lane in self.adaptive:
+            await self.adaptive[lane].acquire()
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiting[lane].append(waiter)
+        if self._timer is None:
+            self._release()
+        await waiter
+
+    def _release(self):
+        self._timer = None
+        for lane in self.lanes:
+            queue = self.waiting[lane]
+            while queue:
+                if queue[0].done():
+                    # cancelled while waiting
+                    queue.popleft()
+                elif self.bucket.try_acquire():
+                    queue.popleft().set_result(None)
+                else:
+                    self._timer = asyncio.get_event_loop().call_later(self.bucket.delay(), self._release)
+                    return
+
+    def throttled(self, lane):
+        """ The server pushed back on a request from `lane` """
+        self.throttled_total[lane] += 1
+        bucket = self.adaptive.get(lane)
+        if bucket is not None:
+            bucket.set_rate(max(self.min_rate, bucket.rate / 2))
+            bucket.tokens = min(bucket.tokens, 0)
+
+    def succeeded(self, lane):
+        bucket = self.adaptive.get(lane)
+        if bucket is not None and bucket.rate < self.bucket.rate:
+            bucket.set_rate(min(self.bucket.rate, bucket.rate + self.increase))
+
+    def state(self):
+        """ Tokens left in the shared bucket and {lane: {"rate", "waiting", "throttled"}} """
+        self.bucket._refill()
+        lanes = {}
+        for lane in self.lanes:
+            lanes[lane] = {
+                "rate": self.adaptive[lane].rate if lane in self.adaptive else self.bucket.rate,
+                "waiting": sum(not waiter.done() for waiter in self.waiting[lane]),
+                "throttled": self.throttled_total[lane],
+                }
+        return self.bucket.tokens, lanes
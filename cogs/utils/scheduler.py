@@ -0,0 +1,250 @@
+import calendar
+import heapq
+import mmap
+import os
+import random
+import struct
+import time
+from collections import deque
+
+
+# snapshot file: magic, format version, record count, then per record the
+# lengths of bundle_id/country/version, the number of recorded changes,
+# interval, due, checked, released (NaN when unknown), the encoded strings
+# and the change timestamps. Version 1 records have no changes
+SNAPSHOT_MAGIC = b"AMPS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sHI")
+SNAPSHOT_RECORD = struct.Struct("<HBBBdddd")
+SNAPSHOT_RECORD_V1 = struct.Struct("<HBBdddd")
+
+
+def release_timestamp(info):
+    """ currentVersionReleaseDate of a lookup result as a UNIX timestamp, or None """
+    try:
+        return calendar.timegm(time.strptime(info["currentVersionReleaseDate"], "%Y-%m-%dT%H:%M:%SZ"))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class PollState:
+    __slots__ = ("interval", "due", "version", "released", "changes", "checked", "scheduled")
+
+    def __init__(self, interval, due):
+        self.interval = interval
+        self.due = due
+        self.scheduled = True
+        self.version = None
+        self.released = None
+        self.checked = None
+        self.changes = deque(maxlen=8)
+
+
+class PollScheduler:
+    """ Min-heap of next-due times for (bundle_id, country) keys.
+
+    Each key's interval adapts to how often the app updates: the mean gap
+    between updates we've detected, or failing that the age of its current
+    version. An app updating every `reference_period` is polled every
+    `reference_interval`, and the interval grows with the period raised to
+    `exponent`, clamped to [min_interval, max_interval]. With the defaults,
+    apps updating weekly or more often are polled at least every 3 minutes,
+    monthly ones about every 6 and yearly ones about every 22.
+    New keys are spread randomly over their first interval so checks don't
+    land in one burst. Keys that stop being polled keep their state while
+    they're still watched, so the update history survives until the next
+    time someone is waiting on them. """
+    def __init__(self, min_interval=60, max_interval=60*60*6, initial_interval=60*3, reference_period=60*60*24*7, reference_interval=60*3, exponent=0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        self.reference_period = reference_period
+        self.reference_interval = reference_interval
+        self.exponent = exponent
+        self._heap = []
+        self._state = {}
+
+    def __len__(self):
+        return sum(state.scheduled for state in self._state.values())
+
+    def __contains__(self, key):
+        state = self._state.get(key)
+        return state is not None and state.scheduled
+
+    def state(self, key):
+        return self._state.get(key)
+
+    def _push(self, key, state):
+        heapq.heappush(self._heap, (state.due, key))
+
+    def add(self, key, spread=None, now=None):
+        """ Start polling key, first check at a random point within `spread` seconds """
+        state = self._state.get(key)
+        if state is not None and state.scheduled:
+            return
+        now = time.time() if now is None else now
+        spread = self.initial_interval if spread is None else spread
+        if state is None:
+            state = self._state[key] = PollState(self.initial_interval, now)
+        state.scheduled = True
+        state.due = now + random.uniform(0, min(spread, state.interval))
+        self._push(key, state)
+
+    def unschedule(self, key):
+        """ Stop polling key, keeping what we know about it """
+        # heap entries for unscheduled keys are skipped when they come up
+        state = self._state.get(key)
+        if state is not None:
+            state.scheduled = False
+
+    def remove(self, key):
+        self._state.pop(key, None)
+
+    def sync(self, keys, spread=None, now=None, keep=()):
+        """ Poll exactly `keys`: add the new ones and stop the rest. Stopped keys in
+        `keep` hold on to their state, the others are forgotten """
+        keys = set(keys)
+        keep = set(keep)
+        for key in list(self._state):
+            if key in keys:
+                continue
+            if key in keep:
+                self.unschedule(key)
+            else:
+                self.remove(key)
+        for key in keys:
+            self.add(key, spread, now)
+
+    def pop_due(self, now=None):
+        """ Keys whose checks are due, removed from the heap until rescheduled """
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, key = heapq.heappop(self._heap)
+            state = self._state.get(key)
+            if state is not None and state.scheduled and state.due == when:
+                due.append(key)
+        return due
+
+    def next_due(self):
+        """ Seconds until the next check, None if nothing is scheduled """
+        while self._heap:
+            when, key = self._heap[0]
+            state = self._state.get(key)
+            if state is not None and state.scheduled and state.due == when:
+                return max(0.0, when - time.time())
+            heapq.heappop(self._heap)
+        return None
+
+    def record(self, key, info, now=None):
+        """ Reschedule key after a successful check, returns True if its version changed """
+        state = self._state.get(key)
+        if state is None:
+            return False
+        now = time.time() if now is None else now
+        changed = False
+        if info:
+            released = release_timestamp(info)
+            changed = state.version is not None and info["version"] != state.version
+            if changed:
+                # the release date, as the key may not have been polled when it came out
+                state.changes.append(released or now)
+            state.version = info["version"]
+            state.released = released or state.released
+        state.checked = now
+        state.interval = self.interval(state, now)
+        state.due = now + state.interval
+        if state.scheduled:
+            self._push(key, state)
+        return changed
+
+    def retry(self, key, now=None):
+        """ Reschedule key after a failed check, backing off up to max_interval """
+        state = self._state.get(key)
+        if state is None:
+            return
+        now = time.time() if now is None else now
+        state.interval = min(self.max_interval, state.interval * 2)
+        state.due = now + random.uniform(state.interval / 2, state.interval)
+        if state.scheduled:
+            self._push(key, state)
+
+    def snapshot(self, path):
+        """ Atomically write every key's poll state to path """
+        records = []
+        for (bundle_id, country), state in self._state.items():
+            strings = [bundle_id.encode(), country.encode(), (state.version or "").encode()]
+            records.append(SNAPSHOT_RECORD.pack(
+                len(strings[0]), len(strings[1]), len(strings[2]), len(state.changes),
+                state.interval, state.due,
+                state.checked if state.checked is not None else float("nan"),
+                state.released if state.released is not None else float("nan"),
+                ) + b"".join(strings) + struct.pack("<{}d".format(len(state.changes)), *state.changes))
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(records)))
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def restore(self, path, now=None):
+        """ Load poll state written by snapshot(), returns the number of keys restored.
+
+        Checks that fell due while we were down are spread over initial_interval
+        rather than all run at once. """
+        try:
+            records = self._read_snapshot(path)
+        except FileNotFoundError:
+            return 0
+        except (ValueError, struct.error, UnicodeDecodeError) as exc:
+            print("[!] Ignoring unreadable poll state snapshot:", exc)
+            return 0
+        now = time.time() if now is None else now
+        for key, latest, interval, due, checked, released, changes in records:
+            if due < now:
+                due = now + random.uniform(0, min(interval, self.initial_interval))
+            state = self._state[key] = PollState(interval, due)
+            state.version = latest or None
+            # NaN marks "unknown"
+            state.checked = None if checked != checked else checked
+            state.released = None if released != released else released
+            state.changes.extend(changes)
+            self._push(key, state)
+        return len(records)
+
+    @staticmethod
+    def _read_snapshot(path):
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, count = SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+                raise ValueError("unknown snapshot format {}".format(version))
+            records = []
+            offset = SNAPSHOT_HEADER.size
+            for _ in range(count):
+                if version == 1:
+                    bundle_length, country_length, version_length, interval, due, checked, released = SNAPSHOT_RECORD_V1.unpack_from(data, offset)
+                    change_count = 0
+                    offset += SNAPSHOT_RECORD_V1.size
+                else:
+                    bundle_length, country_length, version_length, change_count, interval, due, checked, released = SNAPSHOT_RECORD.unpack_from(data, offset)
+                    offset += SNAPSHOT_RECORD.size
+                strings = []
+                for length in (bundle_length, country_length, version_length):
+                    strings.append(data[offset:offset + length].decode())
+                    offset += length
+                changes = struct.unpack_from("<{}d".format(change_count), data, offset)
+                offset += 8 * change_count
+                records.append(((strings[0], strings[1]), strings[2], interval, due, checked, released, changes))
+        return records
+
+    def interval(self, state, now):
+        if len(state.changes) > 1:
+            changes = list(state.changes)
+            period = (changes[-1] - changes[0]) / (len(changes) - 1)
+        elif state.released is not None:
+            period = now - state.released
+        else:
+            return self.initial_interval
+        interval = self.reference_interval * (max(period, 0) / self.reference_period) ** self.exponent
+        return max(self.min_interval, min(self.max_interval, interval))
@@ -0,0 +1,553 @@
+import asyncio
+import functools
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+from gspread.utils import rowcol_to_a1
+
+from .metrics import metrics
+
+
+HEADER = ["bundle_id", "name", "version", "country", "icon", "url", "notified"]
+
+# gspread is blocking HTTP, so every call runs on this bounded pool instead of the event loop
+sheets_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sheets")
+
+
+sheets_calls = metrics.counter("appmonitor_sheets_calls_total", "Google Sheets calls by method", ["method"])
+sheets_seconds = metrics.histogram("appmonitor_sheets_call_seconds", "Google Sheets call latency, including time queued for the executor", ["method"])
+
+
+async def run_sheets(fn, *args, **kwargs):
+    """ Run a blocking gspread/oauth2client call on the sheets executor """
+    method = getattr(fn, "__name__", "call")
+    sheets_calls.inc(method)
+    with sheets_seconds.time(method):
+        return await asyncio.get_event_loop().run_in_executor(sheets_executor, functools.partial(fn, *args, **kwargs))
+
+
+def cell_range(title, cells):
+    """ A1 range and value rectangle covering {(row, col): value}. Cells in the rectangle
+    that aren't being written are None, which the Sheets API leaves untouched. gspread
+    3.1's update_cells() can't be used for this: it lines sparse batches up from the
+    first cell's column rather than the leftmost one, writing values into wrong cells """
+    top = min(row for row, col in cells)
+    bottom = max(row for row, col in cells)
+    left = min(col for row, col in cells)
+    right = max(col for row, col in cells)
+    values = [[cells.get((row, col)) for col in range(left, right + 1)] for row in range(top, bottom + 1)]
+    return "'{}'!{}:{}".format(title.replace("'", "''"), rowcol_to_a1(top, left), rowcol_to_a1(bottom, right)), values
+
+
+def normalize(entry):
+    """ Watch-list row as stored, with the version as text and notified as 0/1 """
+    entry = dict(entry)
+    entry["version"] = str(entry.get("version", ""))
+    entry["notified"] = int(entry.get("notified") or 0)
+    return entry
+
+
+class WatchListStore:
+    """ Storage for users' watch-lists and the countries table.
+
+    Entries are dicts keyed by HEADER. Users are identified by their Discord ID as a string. """
+    async def users(self):
+        raise NotImplementedError
+
+    async def has_user(self, user_id):
+        return user_id in await self.users()
+
+    async def add_user(self, user_id):
+        raise NotImplementedError
+
+    async def entries(self, user_id):
+        raise NotImplementedError
+
+    async def find_entry(self, user_id, bundle_id):
+        for entry in await self.entries(user_id):
+            if entry["bundle_id"] == bundle_id:
+                return entry
+
+    async def add_entry(self, user_id, entry):
+        await self.add_entries(user_id, [entry])
+
+    async def add_entries(self, user_id, entries):
+        """ Append several entries in one write """
+        raise NotImplementedError
+
+    async def remove_entry(self, user_id, bundle_id):
+        """ Remove an entry, returns the removed entry or None """
+        raise NotImplementedError
+
+    async def update_entry(self, user_id, bundle_id, **fields):
+        """ Update some fields of an entry, returns the updated entry or None """
+        raise NotImplementedError
+
+    async def mark_notified(self, user_id, bundle_id, version, notified=1):
+        """ Set notified on an entry only if it still acknowledges `version`, so an
+        update made since the notification was queued isn't overwritten, and isn't
+        set already, so only one worker claims a notification. notified=0 gives a
+        claim back. Returns the updated entry or None """
+        entry = await self.find_entry(user_id, bundle_id)
+        if entry and entry["version"] == str(version) and entry["notified"] != notified:
+            return await self.update_entry(user_id, bundle_id, notified=notified)
+
+    async def countries(self):
+        """ Rows of the countries table, as {"country": name, "code": code} and optionally "aliases", comma separated """
+        raise NotImplementedError
+
+    async def set_countries(self, countries):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SheetStore(WatchListStore):
+    """ The "AppMonitor" spreadsheet: a "countries" sheet and one worksheet per user.
+
+    Cell updates are written behind: they are queued per worksheet, coalesced,
+    and sent as one values_update() call per worksheet once max_pending cells are
+    queued or flush_interval seconds have passed. Reads through the store see
+    queued values. All gspread calls run on the sheets executor.
+
+    Worksheet handles are kept, and so are the rows of every worksheet read in
+    full, so later lookups by bundle ID don't need a find() round trip. """
+    def __init__(self, spreadsheet, max_pending=200, flush_interval=10):
+        self.spreadsheet = spreadsheet
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._flushing = {}
+        self._locks = defaultdict(asyncio.Lock)
+        self._flusher = None
+
+    @property
+    def spreadsheet(self):
+        return self._spreadsheet
+
+    @spreadsheet.setter
+    def spreadsheet(self, spreadsheet):
+        # handles hold on to the client they were opened with
+        self._spreadsheet = spreadsheet
+        self._worksheets = {}
+        self._rows = {}
+
+    async def _worksheet(self, title):
+        worksheet = self._worksheets.get(title)
+        if worksheet is None:
+            worksheet = self._worksheets[title] = await run_sheets(self.spreadsheet.worksheet, title)
+        return worksheet
+
+    async def _locate(self, user_id, worksheet, bundle_id):
+        """ (row, values) of bundle ID's row, or (None, None) """
+        rows = self._rows.get(user_id)
+        if rows is not None:
+            for row, values in enumerate(rows, start=2):
+                if values[0] == bundle_id:
+                    return row, values
+            return None, None
+        try:
+            cell = await run_sheets(worksheet.find, bundle_id)
+        except gspread.exceptions.CellNotFound:
+            return None, None
+        return cell.row, await run_sheets(worksheet.row_values, cell.row)
+
+    def _overlay(self, user_id, row, values):
+        """ Apply queued writes for a row (1-based) to the values read for it """
+        values = list(values) + [""] * (len(HEADER) - len(values))
+        for cells in (self._flushing.get(user_id, {}), self._pending.get(user_id, {})):
+            for (pending_row, col), value in cells.items():
+                if pending_row == row:
+                    values[col - 1] = value
+        return normalize(dict(zip(HEADER, values)))
+
+    async def users(self):
+        worksheets = await run_sheets(self.spreadsheet.worksheets)
+        for worksheet in worksheets:
+            self._worksheets.setdefault(worksheet.title, worksheet)
+        return [worksheet.title for worksheet in worksheets if worksheet.title != "countries"]
+
+    async def add_user(self, user_id):
+        worksheet = await run_sheets(self.spreadsheet.add_worksheet, title=user_id, rows="0", cols="0")
+        await run_sheets(worksheet.append_row, HEADER)
+        self._worksheets[user_id] = worksheet
+        self._rows[user_id] = []
+
+    async def entries(self, user_id):
+        worksheet = await self._worksheet(user_id)
+        # get_all_records() would turn versions like "1.10" into floats
+        rows = await run_sheets(worksheet.get_all_values)
+        self._rows[user_id] = [list(values) + [""] * (len(HEADER) - len(values)) for values in rows[1:]]
+        return [self._overlay(user_id, row, values) for row, values in enumerate(rows[1:], start=2)]
+
+    async def find_entry(self, user_id, bundle_id):
+        row, values = await self._locate(user_id, await self._worksheet(user_id), bundle_id)
+        if row:
+            return self._overlay(user_id, row, values)
+
+    async def add_entries(self, user_id, entries):
+        worksheet = await self._worksheet(user_id)
+        rows = [[str(entry[column]) for column in HEADER] for entry in entries]
+        # gspread has no append_rows() yet, this is what append_row() sends, with every row at once
+        await run_sheets(self.spreadsheet.values_append, worksheet.title, {"valueInputOption": "RAW"}, {"values": rows})
+        if user_id in self._rows:
+            self._rows[user_id].extend(rows)
+
+    async def remove_entry(self, user_id, bundle_id):
+        async with self._locks[user_id]:
+            # queued writes address rows by number, which a deletion shifts
+            await self._flush_user(user_id)
+            worksheet = await self._worksheet(user_id)
+            row, values = await self._locate(user_id, worksheet, bundle_id)
+            if not row:
+                return
+            try:
+                await run_sheets(worksheet.delete_row, row)
+            except Exception:
+                # don't trust the remembered rows if we can't tell what happened
+                self._rows.pop(user_id, None)
+                raise
+            if user_id in self._rows:
+                del self._rows[user_id][row - 2]
+        return normalize(dict(zip(HEADER, values)))
+
+    async def update_entry(self, user_id, bundle_id, **fields):
+        return await self._update(user_id, bundle_id, fields)
+
+    async def mark_notified(self, user_id, bundle_id, version, notified=1):
+        return await self._update(user_id, bundle_id, {"notified": notified}, {"version": str(version), "notified": 1 - notified})
+
+    async def _update(self, user_id, bundle_id, fields, where=None):
+        """ Queue writes to an entry's cells; with `where`, only if the entry still has those values """
+        async with self._locks[user_id]:
+            worksheet = await self._worksheet(user_id)
+            row, values = await self._locate(user_id, worksheet, bundle_id)
+            if not row:
+                return
+            entry = self._overlay(user_id, row, values)
+            if where and any(entry[column] != value for column, value in where.items()):
+                return
+            pending = self._pending.setdefault(user_id, {})
+            for column, value in fields.items():
+                pending[(row, HEADER.index(column) + 1)] = str(value)
+                if user_id in self._rows:
+                    self._rows[user_id][row - 2][HEADER.index(column)] = str(value)
+        entry.update(fields)
+        await self._schedule_flush()
+        return normalize(entry)
+
+    async def countries(self):
+        worksheet = await self._worksheet("countries")
+        return await run_sheets(worksheet.get_all_records)
+
+    async def _schedule_flush(self):
+        if sum(len(cells) for cells in self._pending.values()) >= self.max_pending:
+            await self.flush()
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception as exc:
+            print("[!] Could not flush spreadsheet writes:", exc)
+
+    async def _flush_user(self, user_id):
+        cells = self._pending.pop(user_id, None)
+        if not cells:
+            return
+        self._flushing[user_id] = cells
+        try:
+            worksheet = await self._worksheet(user_id)
+            cells_range, values = cell_range(worksheet.title, cells)
+            await run_sheets(self.spreadsheet.values_update, cells_range, {"valueInputOption": "RAW"}, {"values": values})
+        except Exception:
+            # keep them, without clobbering anything queued since
+            cells.update(self._pending.get(user_id, {}))
+            self._pending[user_id] = cells
+            raise
+        finally:
+            del self._flushing[user_id]
+
+    async def flush(self, user_id=None):
+        """ Send queued cell updates, one batched call per worksheet """
+        for user_id in ([user_id] if user_id else list(self._pending)):
+            async with self._locks[user_id]:
+                await self._flush_user(user_id)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
+
+
+class SQLiteStore(WatchListStore):
+    """ Local SQLite database, indexed by user and by (bundle_id, country) """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            user_id TEXT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            bundle_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            country TEXT NOT NULL,
+            icon TEXT NOT NULL,
+            url TEXT NOT NULL,
+            notified INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (user_id, bundle_id)
+        );
+        CREATE INDEX IF NOT EXISTS entries_by_app ON entries (bundle_id, country);
+        CREATE TABLE IF NOT EXISTS countries (
+            country TEXT PRIMARY KEY,
+            code TEXT NOT NULL,
+            aliases TEXT NOT NULL DEFAULT ''
+        );
+    """
+
+    def __init__(self, path="appmonitor.db"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(self.SCHEMA)
+        # databases created before countries had aliases
+        if "aliases" not in [row["name"] for row in self.db.execute("PRAGMA table_info(countries)")]:
+            with self.db:
+                self.db.execute("ALTER TABLE countries ADD COLUMN aliases TEXT NOT NULL DEFAULT ''")
+
+    def _entry(self, row):
+        return normalize({column: row[column] for column in HEADER})
+
+    async def users(self):
+        return [row["id"] for row in self.db.execute("SELECT id FROM users")]
+
+    async def has_user(self, user_id):
+        return self.db.execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone() is not None
+
+    async def add_user(self, user_id):
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+
+    async def entries(self, user_id):
+        rows = self.db.execute("SELECT * FROM entries WHERE user_id = ? ORDER BY rowid", (user_id,))
+        return [self._entry(row) for row in rows]
+
+    async def find_entry(self, user_id, bundle_id):
+        row = self.db.execute("SELECT * FROM entries WHERE user_id = ? AND bundle_id = ?", (user_id, bundle_id)).fetchone()
+        if row:
+            return self._entry(row)
+
+    async def add_entries(self, user_id, entries):
+        entries = [normalize(entry) for entry in entries]
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entries (user_id, {}) VALUES (?, {})".format(", ".join(HEADER), ", ".join("?" * len(HEADER))),
+                [[user_id] + [entry[column] for column in HEADER] for entry in entries]
+                )
+
+    async def remove_entry(self, user_id, bundle_id):
+        entry = await self.find_entry(user_id, bundle_id)
+        if entry:
+            with self.db:
+                self.db.execute("DELETE FROM entries WHERE user_id = ? AND bundle_id = ?", (user_id, bundle_id))
+        return entry
+
+    async def update_entry(self, user_id, bundle_id, **fields):
+        fields = {column: fields[column] for column in HEADER if column in fields}
+        if not fields:
+            return await self.find_entry(user_id, bundle_id)
+        if "version" in fields:
+            fields["version"] = str(fields["version"])
+        if "notified" in fields:
+            fields["notified"] = int(fields["notified"])
+        with self.db:
+            self.db.execute(
+                "UPDATE entries SET {} WHERE user_id = ? AND bundle_id = ?".format(", ".join(column + " = ?" for column in fields)),
+                list(fields.values()) + [user_id, bundle_id]
+                )
+        return await self.find_entry(user_id, bundle_id)
+
+    async def mark_notified(self, user_id, bundle_id, version, notified=1):
+        # a single statement, so two workers can't both claim the same notification
+        with self.db:
+            updated = self.db.execute(
+                "UPDATE entries SET notified = ? WHERE user_id = ? AND bundle_id = ? AND version = ? AND notified != ?",
+                (notified, user_id, bundle_id, str(version), notified)
+                ).rowcount
+        if updated:
+            return await self.find_entry(user_id, bundle_id)
+
+    async def countries(self):
+        return [{"country": row["country"], "code": row["code"], "aliases": row["aliases"]} for row in self.db.execute("SELECT country, code, aliases FROM countries")]
+
+    async def set_countries(self, countries):
+        with self.db:
+            self.db.execute("DELETE FROM countries")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO countries (country, code, aliases) VALUES (?, ?, ?)",
+                [(row["country"], row["code"], str(row.get("aliases") or "")) for row in countries]
+                )
+
+    async def close(self):
+        self.db.close()
+
+
+class CachedStore(WatchListStore):
+    """ Write-through in-memory copy of another store's users and watch-lists.
+
+    Everything is loaded on first use; the cog's own mutations go to the backend
+    and then to memory, and reconcile() reloads it to pick up outside changes.
+    The reload runs without blocking mutations: users changed while it was
+    loading keep their in-memory watch-lists when the new data is swapped in,
+    since the loaded copy may predate the change. Mutations of the same user
+    are serialized so check-then-write stays consistent. """
+    def __init__(self, backend):
+        self.backend = backend
+        self._users = None
+        self._lock = asyncio.Lock()
+        self._user_locks = {}
+        # users mutated while a reload is in progress, None when there is none
+        self._dirty = None
+
+    async def _loaded(self):
+        if self._users is None:
+            async with self._lock:
+                if self._users is None:
+                    self._users = await self._load()
+        return self._users
+
+    async def _load(self):
+        user_ids = await self.backend.users()
+        entries = await asyncio.gather(*[self.backend.entries(user_id) for user_id in user_ids])
+        return dict(zip(user_ids, entries))
+
+    async def reconcile(self):
+        """ Reload everything from the backend """
+        await self._loaded()
+        async with self._lock:
+            self._dirty = set()
+            try:
+                users = await self._load()
+            except BaseException:
+                self._dirty = None
+                raise
+            # nothing awaits between here and the swap, so no mutation can slip in
+            for user_id in self._dirty:
+                if user_id in self._users:
+                    users[user_id] = self._users[user_id]
+                else:
+                    users.pop(user_id, None)
+            self._users, self._dirty = users, None
+
+    def _user_lock(self, user_id):
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
+
+    def _changed(self, user_id):
+        if self._dirty is not None:
+            self._dirty.add(user_id)
+
+    def _find(self, user_id, bundle_id):
+        for entry in self._users.get(user_id, []):
+            if entry["bundle_id"] == bundle_id:
+                return entry
+
+    async def users(self):
+        return list(await self._loaded())
+
+    async def has_user(self, user_id):
+        return user_id in await self._loaded()
+
+    async def add_user(self, user_id):
+        await self._loaded()
+        async with self._user_lock(user_id):
+            await self.backend.add_user(user_id)
+            self._users.setdefault(user_id, [])
+            self._changed(user_id)
+
+    async def entries(self, user_id):
+        return [dict(entry) for entry in (await self._loaded()).get(user_id, [])]
+
+    async def find_entry(self, user_id, bundle_id):
+        await self._loaded()
+        entry = self._find(user_id, bundle_id)
+        if entry:
+            return dict(entry)
+
+    async def add_entries(self, user_id, entries):
+        await self._loaded()
+        async with self._user_lock(user_id):
+            await self.backend.add_entries(user_id, entries)
+            self._users.setdefault(user_id, []).extend(normalize(entry) for entry in entries)
+            self._changed(user_id)
+
+    async def remove_entry(self, user_id, bundle_id):
+        await self._loaded()
+        async with self._user_lock(user_id):
+            if not self._find(user_id, bundle_id):
+                return
+            entry = await self.backend.remove_entry(user_id, bundle_id)
+            self._users[user_id] = [entry for entry in self._users.get(user_id, []) if entry["bundle_id"] != bundle_id]
+            self._changed(user_id)
+        return entry
+
+    async def update_entry(self, user_id, bundle_id, **fields):
+        await self._loaded()
+        async with self._user_lock(user_id):
+            if not self._find(user_id, bundle_id):
+                return
+            entry = await self.backend.update_entry(user_id, bundle_id, **fields)
+            cached = self._find(user_id, bundle_id)
+            if entry and cached:
+                cached.update(entry)
+            self._changed(user_id)
+        return entry
+
+    async def mark_notified(self, user_id, bundle_id, version, notified=1):
+        await self._loaded()
+        async with self._user_lock(user_id):
+            cached = self._find(user_id, bundle_id)
+            if not cached or cached["version"] != str(version):
+                return
+            entry = await self.backend.mark_notified(user_id, bundle_id, version, notified)
+            # if it wasn't ours to claim our copy is stale, e.g. another worker sent the notification already
+            fresh = entry or await self.backend.find_entry(user_id, bundle_id)
+            # a reload may have swapped the watch-lists while we were waiting
+            cached = self._find(user_id, bundle_id)
+            if fresh and cached:
+                cached.update(fresh)
+            self._changed(user_id)
+        return entry
+
+    async def countries(self):
+        return await self.backend.countries()
+
+    async def set_countries(self, countries):
+        await self.backend.set_countries(countries)
+
+    async def close(self):
+        await self.backend.close()
+
+
+async def migrate(source, target):
+    """ Copy every watch-list and the countries table from source into target,
+    returns (users, entries) copied """
+    await target.set_countries(await source.countries())
+    users = entries = 0
+    for user_id in await source.users():
+        await target.add_user(user_id)
+        user_entries = await source.entries(user_id)
+        if user_entries:
+            await target.add_entries(user_id, user_entries)
+        entries += len(user_entries)
+        users += 1
+    return users, entries